@@ -0,0 +1,295 @@
+'''
+python benchPredict.py [-opt val] | [--opt val]
+
+Benchmarks the prediction path of predict.py on synthetic data.  A
+set of synthetic BV-BRC feature tabs and a synthetic models directory
+(small XGBoost models trained on random k-mer counts) are generated,
+then predictions are timed stage by stage at each scale.  Everything
+runs offline and is seeded, so runs can be compared across releases.
+
+-w | --work_dir : directory to generate the synthetic data in.  This directory will be cleared!  Defaults to "bench/"
+-g | --genomes : comma separated list of genome counts to time.  Defaults to "1,10,100"
+-M | --models : comma separated list of PLF model counts to time.  Defaults to "10,100"
+-F | --folds : comma separated list of fold counts to time.  Defaults to "5"
+-e | --engines : comma separated list of inference engines to time.  Defaults to "xgb,numpy"
+-n | --threads : number of threads to predict with.  Defaults to 1
+-c | --n_cons : number of conserved PLFs per genome.  Defaults to 100
+-a | --n_acc : number of other features per genome.  Defaults to 4000
+-r | --rounds : number of boosting rounds per model.  Defaults to 10
+-d | --depth : max tree depth of the models.  Defaults to 4
+-b | --bundle : also time predictions from a model bundle made by packModels.py
+-s | --seed : random seed.  Defaults to 0
+
+Output is a tab delimited table, to standard output, with the wall
+time, CPU time, and peak memory of each stage at each scale.
+'''
+
+from sys import stderr
+import os
+from optparse import OptionParser, Values
+import numpy as np
+import xgboost as xgb
+import predict
+import packModels
+
+# columns of the synthetic feature tabs
+FEATCOLS = ['contig_id', 'feature_id', 'type', 'location', 'start', 'stop', 'strand', 'function', 'aliases', 'plfam', 'pgfam', 'figfam', 'evidence_codes', 'nucleotide_sequence', 'aa_sequence']
+
+# outputs s to stderr
+def err(s):
+	stderr.write(s)
+
+# given a comma separated string of integers
+# returns the list of integers
+def parseIntLst(s):
+	return [int(i) for i in s.split(',') if i != '']
+
+# grab options for the script and returns them
+def getOptions():
+	parser = OptionParser()
+
+	parser.add_option('-w', '--work_dir', help="Directory to generate the synthetic data in.  This directory will be cleared!", metavar="DIR", default='bench/', dest='workDir')
+	parser.add_option('-g', '--genomes', help="Comma separated list of genome counts to time", metavar="LIST", default='1,10,100', dest='genomes')
+	parser.add_option('-M', '--models', help="Comma separated list of PLF model counts to time", metavar="LIST", default='10,100', dest='models')
+	parser.add_option('-F', '--folds', help="Comma separated list of fold counts to time", metavar="LIST", default='5', dest='folds')
+	parser.add_option('-e', '--engines', help="Comma separated list of inference engines to time", metavar="LIST", default='xgb,numpy', dest='engines')
+	parser.add_option('-n', '--threads', help="Number of threads to predict with", metavar="INT", type=int, default=1, dest='threads')
+	parser.add_option('-c', '--n_cons', help="Number of conserved PLFs per genome", metavar="INT", type=int, default=100, dest='nCons')
+	parser.add_option('-a', '--n_acc', help="Number of other features per genome", metavar="INT", type=int, default=4000, dest='nAcc')
+	parser.add_option('-r', '--rounds', help="Number of boosting rounds per model", metavar="INT", type=int, default=10, dest='rounds')
+	parser.add_option('-d', '--depth', help="Max tree depth of the models", metavar="INT", type=int, default=4, dest='depth')
+	parser.add_option('-b', '--bundle', help="Also time predictions from a model bundle", action='store_true', default=False, dest='bundle')
+	parser.add_option('-s', '--seed', help="Random seed", metavar="INT", type=int, default=0, dest='seed')
+
+	options,args = parser.parse_args()
+
+	options.workDir = predict.cleanDir(options.workDir)
+	options.genomes = parseIntLst(options.genomes)
+	options.models = parseIntLst(options.models)
+	options.folds = parseIntLst(options.folds)
+	options.engines = options.engines.split(',')
+
+	return options, parser
+
+# given a length and alphabet, makes a random sequence
+# returns the sequence string
+def randSeq(n, alpha):
+	alpha = np.frombuffer(alpha, dtype=np.uint8)
+	return alpha[np.random.randint(0, len(alpha), n)].tostring()
+
+# given options, writes the list of conserved PLFs
+# returns the list of conserved PLFs
+def makeConPLFs(options):
+	conPLFs = ['PLF_561_%08d' % i for i in range(0,options.nCons)]
+
+	f = open(options.workDir + 'plf.con.lst', 'w')
+	for i in conPLFs:
+		f.write(i + '\n')
+	f.close()
+
+	return conPLFs
+
+# given options, a genome number, list of conserved PLFs, and the
+# conserved gene sequences shared by all genomes, writes a synthetic
+# feature tab.  Conserved genes are mutated a bit so genomes differ.
+# returns the feature tab file name
+def makeFeatTab(options, g, conPLFs, conSeqs):
+	gid = '562.%d' % (g + 1)
+	fNm = options.workDir + 'tabs/' + gid + '.txt'
+	f = open(fNm, 'w')
+	f.write('\t'.join(FEATCOLS) + '\n')
+
+	# for each feature
+	#   conserved features come first, the rest get a random PLF
+	#   make the sequence
+	#   write the line
+	for i in range(0,options.nCons + options.nAcc):
+		if i < options.nCons:
+			plf = conPLFs[i]
+			seq = np.frombuffer(conSeqs[i], dtype=np.uint8).copy()
+			n = len(seq) / 100
+			seq[np.random.randint(0, len(seq), n)] = np.frombuffer(randSeq(n, 'ACGT'), dtype=np.uint8)
+			seq = seq.tostring()
+		else:
+			plf = 'PLF_561_%08d' % np.random.randint(options.nCons, options.nCons + 20000)
+			seq = randSeq(np.random.randint(300, 1501), 'ACGT')
+
+		start = i * 1000 + 1
+		arr = ['contig_1', 'fig|%s.peg.%d' % (gid, i + 1), 'CDS', 'contig_1_%d+%d' % (start, len(seq)), str(start), str(start + len(seq) - 1), '+', 'hypothetical protein', '', plf, '', '', '', seq, randSeq(len(seq) / 3, 'ACDEFGHIKLMNPQRSTVWY')]
+		f.write('\t'.join(arr) + '\n')
+
+	f.close()
+
+	return fNm
+
+# given options and list of conserved PLFs, writes the synthetic
+# feature tabs for the most genomes being timed
+# returns the list of feature tab file names
+def makeFeatTabs(options, conPLFs):
+	os.mkdir(options.workDir + 'tabs/')
+	conSeqs = [randSeq(np.random.randint(600, 1501), 'ACGT') for i in conPLFs]
+
+	err("Making feature tabs...\n")
+	fLst = []
+	for g in range(0,max(options.genomes)):
+		fLst.append(makeFeatTab(options, g, conPLFs, conSeqs))
+
+	return fLst
+
+# given options, trains the models for the most PLFs and folds being
+# timed.  Each model is trained on random k-mer counts with random
+# labels.
+def makeModelPool(options):
+	pDir = options.workDir + 'pool/'
+	os.mkdir(pDir)
+
+	# every canonical k-mer is a feature
+	k = 7
+	kmers = []
+	for i in range(0,4**k):
+		kmer = ''.join(['ACGT'[(i >> (2 * (k - 1 - j))) & 3] for j in range(0,k)])
+		rc = ''.join(['TGCA'['ACGT'.index(c)] for c in reversed(kmer)])
+		if kmer <= rc:
+			kmers.append(kmer)
+
+	# write the params and attribute order shared by all models
+	f = open(pDir + 'model.params', 'w')
+	f.write(str({'kmerSize': k, 'depth': options.depth}) + '\n')
+	f.close()
+	f = open(pDir + 'model.attrOrder', 'w')
+	for i in range(0,len(kmers)):
+		f.write(kmers[i] + '\t' + str(i) + '\n')
+	f.close()
+
+	# for each model
+	#   for each fold
+	#     train on random counts and labels
+	#     save the model
+	err("Training models...\n")
+	params = {'objective': 'binary:logistic', 'max_depth': options.depth, 'eta': 0.3, 'nthread': 1}
+	for m in range(0,max(options.models)):
+		mDir = pDir + 'PLF_562_%08d.tab/' % m
+		os.makedirs(mDir + 'all/')
+		for j in range(0,max(options.folds)):
+			X = np.random.poisson(2, (40, len(kmers))).astype(np.float32)
+			y = np.random.randint(0, 2, 40)
+			mod = xgb.train(params, xgb.DMatrix(X, label=y), options.rounds)
+			mod.save_model(mDir + 'all/model%d.pkl' % j)
+
+# given options, a number of PLF models, and a number of folds, makes
+# a models directory with that many models and folds from the pool by
+# linking to them
+# returns the models directory name
+def makeModelsDir(options, nModel, nFold):
+	pDir = os.path.abspath(options.workDir + 'pool/') + '/'
+	mDir = options.workDir + 'models.%d.%d/' % (nModel, nFold)
+	os.mkdir(mDir)
+
+	for m in range(0,nModel):
+		plf = 'PLF_562_%08d.tab/' % m
+		os.makedirs(mDir + plf + 'all/')
+		os.symlink(pDir + 'model.params', mDir + plf + 'model.params')
+		os.symlink(pDir + 'model.attrOrder', mDir + plf + 'model.attrOrder')
+		for j in range(0,nFold):
+			os.symlink(pDir + plf + 'all/model%d.pkl' % j, mDir + plf + 'all/model%d.pkl' % j)
+
+	return mDir
+
+# given a models directory and output file name, packs the models 
+# into a bundle
+def makeBundle(mDir, oFNm):
+	opts = Values({'modelsDir': mDir, 'outFile': oFNm})
+	index, fLst = packModels.makeIndex(opts)
+	packModels.writeBundle(opts, index, fLst)
+
+# given options, list of feature tabs, models directory (or bundle),
+# and engine, makes predictions the same way predict.py does, timing
+# each stage.  Predictions aren't printed.
+# returns the profile of the run
+def timePredict(options, fLst, models, engine):
+	# write the list of feature tabs for batch mode
+	lstFNm = options.workDir + 'tabs.lst'
+	f = open(lstFNm, 'w')
+	for i in fLst:
+		f.write(i + '\n')
+	f.close()
+
+	opts = Values({
+		'featFile': '',
+		'batch': lstFNm,
+		'conPLFFile': options.workDir + 'plf.con.lst',
+		'modelsDir': models,
+		'plfs': '',
+		'tempDir': options.workDir + 'temp/',
+		'kmerCounter': 'numpy',
+		'threads': options.threads,
+		'poolType': 'thread',
+		'engine': engine,
+		'earlyExit': False,
+		'cacheDir': '',
+		'cacheSize': 1024,
+		'profile': ''
+	})
+	predict.setModelsDir(opts)
+	predict.setPLFs(opts)
+
+	# reset the profile
+	predict.profile['stages'] = []
+	predict.profile['modelLoad'] = 0.0
+	predict.profile['inference'] = 0.0
+
+	genomes = predict.timeStage('getGenomes', predict.getGenomes, opts)
+	k = predict.timeStage('getK', predict.getK, opts)
+	seqLst = predict.timeStage('getConsSeqs', predict.getConsSeqs, opts, genomes)
+	mat = predict.timeStage('makeMatrix', predict.makeMatrix, opts, k, genomes, seqLst)
+	predict.timeStage('predAll', predict.predAll, opts, mat, genomes)
+
+	return predict.profile
+
+# given the scale of a run and its profile, prints a row per stage,
+# the model load and inference times, and the total
+def printProfile(scale, prof):
+	for i in prof['stages']:
+		arr = scale + [i['stage'], '%.4f' % i['wall'], '%.4f' % i['cpu'], str(i['maxRSS'])]
+		print '\t'.join(arr)
+	print '\t'.join(scale + ['modelLoad', '%.4f' % prof['modelLoad'], '', ''])
+	print '\t'.join(scale + ['inference', '%.4f' % prof['inference'], '', ''])
+	wall = sum([i['wall'] for i in prof['stages']])
+	cpu = sum([i['cpu'] for i in prof['stages']])
+	print '\t'.join(scale + ['total', '%.4f' % wall, '%.4f' % cpu, str(max([i['maxRSS'] for i in prof['stages']]))])
+
+# main driver program
+# get options
+# seed and clear the work directory
+# generate feature tabs and models
+# for each scale and engine, time predictions and print the profile
+def main():
+	options, parser = getOptions()
+	np.random.seed(options.seed)
+
+	predict.makeDir(options.workDir, True)
+	conPLFs = makeConPLFs(options)
+	fLst = makeFeatTabs(options, conPLFs)
+	makeModelPool(options)
+
+	# get the models directories (and bundles) for each scale
+	sources = []
+	for m in options.models:
+		for j in options.folds:
+			mDir = makeModelsDir(options, m, j)
+			sources.append([m, j, 'dir', mDir])
+			if options.bundle:
+				bFNm = options.workDir + 'models.%d.%d.bundle' % (m, j)
+				makeBundle(mDir, bFNm)
+				sources.append([m, j, 'bundle', bFNm])
+
+	print '\t'.join(['genomes', 'models', 'folds', 'source', 'engine', 'stage', 'wall', 'cpu', 'maxRSS'])
+	for g in options.genomes:
+		for m, j, src, models in sources:
+			for e in options.engines:
+				err("Timing " + ' '.join([str(g), 'genomes', str(m), 'models', str(j), 'folds', src, e]) + '\n')
+				prof = timePredict(options, fLst[:g], models, e)
+				printProfile([str(g), str(m), str(j), src, e], prof)
+
+if __name__ == '__main__':
+	main()
@@ -1,175 +1,811 @@
 '''
-python getClusters.py [kmc dir] [all fasta kmc] [out pref]
+python getClusters.py [-opt val] | [--opt val] [kmc dir] [all fasta kmc] [out pref]
 
-Given a directory containing KMC output, a KMC output for all the fasta files concatenated together, and a file output prefix, this script will cluster all the KMC files into clusters of 500, 1000, 2000, and 4000.  From each of these, the script will select one "representative" geonome from each cluster.  These subsampled genomes can then be used as a diverse set.  
+Given a directory containing KMC output, a KMC output for all the fasta files concatenated together, and a file output prefix, this script will cluster all the KMC files into clusters of 500, 1000, 2000, and 4000 (or the counts given by --clusts).  From each of these, the script will select one "representative" geonome from each cluster.  These subsampled genomes can then be used as a diverse set.  
+
+The k-mer counts of every genome are converted into a binary count
+store (a .npy file with one row per genome and one column per 2-bit
+encoded k-mer) the first time the script is run.  Later runs load the
+store directly as long as the KMC files haven't changed.
+
+The genomes are clustered with average linkage on L1 distances.  The
+pairwise distances are computed in blocks across a pool of processes
+and written into a memory mapped condensed distance matrix.  Finished
+blocks are recorded, so an interrupted run picks up where it left off.
+The linkage tree is built once and cut at every cluster count.  The
+k-mer counts are loaded into memory, and building the tree copies the
+whole distance matrix into memory (8 bytes per pair of genomes), so
+use the approximate mode when that doesn't fit.
+
+For very large genome sets there is an approximate mode.  Each genome's
+k-mer counts are reduced to a small sketch with a random projection,
+and the sketches are clustered with mini batch k-means, so the time
+grows linearly with the number of genomes rather than quadratically.
+
+Each run saves the clustering state (the centroid and members of every
+cluster).  In update mode, only genomes that aren't in the state are
+added to the count store and assigned to their nearest cluster, then
+the clusters are written out again.
+
+-s | --store : k-mer count store file.  Defaults to "[out pref].kmrs.npy"
+-r | --rebuild : rebuild the k-mer count store (distances and linkage tree) even if it is up to date
+-d | --dist : condensed distance matrix file.  Defaults to "[out pref].dist.npy"
+-n | --threads : number of processes to convert KMC files and compute distances with.  Defaults to 1
+-a | --approx : cluster random projection sketches with mini batch k-means instead of average linkage
+--sketch_size : number of values in each genome's sketch in approximate mode.  Defaults to 256
+--seed : random seed for the approximate mode.  Defaults to 0
+-u | --update : assign genomes that aren't in the saved clustering state to their nearest cluster instead of clustering again
+--state : clustering state file.  Defaults to "[out pref].state.pkl"
+-c | --clusts : comma separated list of cluster counts to get.  Defaults to "500,1000,2000,4000"
+-l | --linkage : file to save the linkage tree to.  If it is newer than the k-mer count store, it is loaded instead of being built again.  Defaults to not saving it
 '''
 
-from sys import argv,stderr
+from sys import stderr
 import os
 from random import shuffle
 from glob import glob
+import cPickle
+import time
+from optparse import OptionParser
+from itertools import imap
+from multiprocessing import Pool
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
+from scipy.spatial.distance import cdist
+from scipy.cluster.hierarchy import linkage, cut_tree
+from scipy.sparse import csr_matrix
+from sklearn.cluster import MiniBatchKMeans
 
-# clean up first parameter directory
-if argv[1][-1] != '/':
-	argv[1] += '/'
-
-# array of clusters to get.  Change it if you want others
+# array of clusters to get by default
 clustsToGet = [500, 1000, 2000, 4000]
 
+# state shared with the distance worker pool.  It is set before the 
+# pool is made so the workers inherit it when they are forked.
+poolState = {}
+
+# max number of distances computed by each block, and the max number 
+# of genomes compared at once within a block
+DISTBLOCK = 2**24
+DISTCHUNK = 1024
+
+# number of genomes projected at once when making sketches
+SKETCHCHUNK = 4096
+
+# number of KMC files converted by each task
+KMCCHUNK = 16
+
 # output s to stderr
 def err(s):
 	stderr.write(s)
 
+# given a directory name, cleans it so it ends with a '/'
+def cleanDir(d):
+	if d == '':
+		return d
+
+	if d[-1] != '/':
+		d += '/'
+
+	return d
+
+# grab options for the script and returns them.  The KMC directory, 
+# all fasta KMC file, and output prefix are positional arguments.
+def getOptions():
+	parser = OptionParser(usage="python getClusters.py [-opt val] | [--opt val] [kmc dir] [all fasta kmc] [out pref]")
+
+	parser.add_option('-s', '--store', help="K-mer count store file.  Defaults to [out pref].kmrs.npy", metavar="FILE", default='', dest='store')
+	parser.add_option('-r', '--rebuild', help="Rebuild the k-mer count store (distances and linkage tree) even if it is up to date", action='store_true', default=False, dest='rebuild')
+	parser.add_option('-d', '--dist', help="Condensed distance matrix file.  Defaults to [out pref].dist.npy", metavar="FILE", default='', dest='dist')
+	parser.add_option('-n', '--threads', help="Number of processes to convert KMC files and compute distances with.  Defaults to 1", metavar="INT", type=int, default=1, dest='threads')
+	parser.add_option('-a', '--approx', help="Cluster random projection sketches with mini batch k-means instead of average linkage.  Scales to much larger genome sets", action='store_true', default=False, dest='approx')
+	parser.add_option('--sketch_size', help="Number of values in each genome's sketch in approximate mode.  Defaults to 256", metavar="INT", type=int, default=256, dest='sketchSize')
+	parser.add_option('-u', '--update', help="Assign genomes that aren't in the saved clustering state to their nearest cluster instead of clustering again", action='store_true', default=False, dest='update')
+	parser.add_option('--state', help="Clustering state file.  Defaults to [out pref].state.pkl", metavar="FILE", default='', dest='state')
+	parser.add_option('--seed', help="Random seed for the approximate mode.  Defaults to 0", metavar="INT", type=int, default=0, dest='seed')
+	parser.add_option('-c', '--clusts', help="Comma separated list of cluster counts to get.  Defaults to " + ','.join([str(i) for i in clustsToGet]), metavar="INT,INT,...", default=','.join([str(i) for i in clustsToGet]), dest='clusts')
+	parser.add_option('-l', '--linkage', help="File to save the linkage tree to.  If it is newer than the k-mer count store, it is loaded instead of being built again.  Defaults to not saving it", metavar="FILE", default='', dest='linkage')
+
+	options,args = parser.parse_args()
+
+	if len(args) != 3:
+		parser.error('expected [kmc dir] [all fasta kmc] [out pref]')
+
+	options.kmcDir = cleanDir(args[0])
+	options.allKMC = args[1]
+	options.outPref = args[2]
+	try:
+		options.clusts = [int(i) for i in options.clusts.split(',') if i.strip() != '']
+	except ValueError:
+		parser.error('--clusts must be a comma separated list of integers')
+	if options.store == '':
+		options.store = options.outPref + '.kmrs.npy'
+	if options.dist == '':
+		options.dist = options.outPref + '.dist.npy'
+	if options.state == '':
+		options.state = options.outPref + '.state.pkl'
+
+	return options, parser
+
+# gets a table that maps a nucleotide (as a byte) to its 2-bit code
+# returns the table as an array
+def getNuclTab():
+	tab = np.zeros(256, dtype=np.int64)
+	for i,j in enumerate('ACGT'):
+		tab[ord(j)] = i
+		tab[ord(j.lower())] = i
+
+	return tab
+
 # this takes a kmc file name and parses it
-# returns a hash that maps k-mer to count
+# returns the k-mer size, an array of 2-bit encoded k-mers, and an 
+# array of their counts
 def parseKMC(fNm):
 	# open file
 	f = open(fNm)
 
-	# hash to return
-	kHsh = {}
+	# lists of k-mers and counts
+	kmrs = []
+	cnts = []
 	# for each line in file
 	#   split by tab
-	#   set k-mer hash
+	#   add the k-mer and count
 	for i in f:
 		i = i.strip('\n').split('\t')
-		kHsh[i[0]] = int(i[1])
+		kmrs.append(i[0])
+		cnts.append(int(i[1]))
 
 	f.close()
 
-	return kHsh
+	if len(kmrs) == 0:
+		return 0, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+
+	# encode every k-mer at once, the first nucleotide is the highest
+	# 2 bits
+	k = len(kmrs[0])
+	nucl = np.frombuffer(''.join(kmrs), dtype=np.uint8).reshape(len(kmrs), k)
+	codes = np.dot(getNuclTab()[nucl], 4 ** np.arange(k - 1, -1, -1, dtype=np.int64))
+
+	return k, codes, np.asarray(cnts, dtype=np.uint32)
 
 # this takes in a file name to a file which contains a list of all
 # k-mers.  
-# returns a hash that maps a k-mer to an array index
-def getKInd(fNm):
-	# parse the KMC file
-	kInd = parseKMC(fNm)
+# returns the k-mer size and a sorted array of the encoded k-mers,
+# which are the columns of the matrix
+def getKCols(fNm):
+	k, codes, cnts = parseKMC(fNm)
 
-	# init the index count to 0
-	cnt = 0
-	# for each element in the k-mer hash
-	#   set the value of the k-mer to the count
-	#   increment the count by 1
-	for i in sorted(kInd):
-		kInd[i] = cnt
-		cnt += 1
+	return k, np.unique(codes)
 
-	return kInd
+# given a KMC file name, gets the genome ID from it
+def getGID(fNm):
+	return '.'.join(os.path.basename(fNm).split('.')[:2])
 
-# takes a KMC output file name and k-mer index hash (from getKInd)
-# returns an array of k-mer counts
-def getKArr(fNm, kInd):
-	# parse the KMC file
-	kHsh = parseKMC(fNm)
-	# init the array of 'nan' values
-	arr = [float('nan')] * len(kInd)
+# given the store file name, gets the name of the file holding the 
+# genome IDs of its rows
+def getGIDFile(sNm):
+	return sNm + '.gids'
+
+# given options, gets the genome IDs of the rows of the k-mer count
+# store
+# returns the list of genome IDs or None if there is no store
+def getStoreGIDs(options):
+	if not os.path.exists(options.store) or not os.path.exists(getGIDFile(options.store)):
+		return None
+
+	f = open(getGIDFile(options.store))
+	gidOrd = [i.strip('\n') for i in f]
+	f.close()
+
+	return gidOrd
+
+# given options and list of KMC files, checks if the k-mer count store
+# is up to date.  It is up to date if it has the same genomes and is 
+# newer than every KMC file.
+# returns True if the store can be used
+def checkStore(options, fLst):
+	if options.rebuild:
+		return False
+
+	gidOrd = getStoreGIDs(options)
+	if gidOrd is None or sorted(gidOrd) != sorted([getGID(i) for i in fLst]):
+		return False
+
+	sTime = os.path.getmtime(options.store)
+	for i in fLst:
+		if os.path.getmtime(i) > sTime:
+			return False
 
-	# for each element in the hash
-	#   get the k-mer index
-	#   set respective array value in array
-	for i in kHsh:
-		ind = kInd[i]
-		arr[ind] = kHsh[i]
+	return True
 
-	return np.asarray(arr)
+# given options, list of KMC files, and k-mer size, converts the KMC 
+# files into the k-mer count store.  Each row is a genome and each 
+# column is a 2-bit encoded k-mer, k-mers a genome doesn't have are 
+# 0.  The store is written to a temp file first so a partial store is
+# never left behind.
+def makeStore(options, fLst, k):
+	tmpFNm = options.store + '.tmp.npy'
+	mat = np.lib.format.open_memmap(tmpFNm, mode='w+', dtype=np.uint32, shape=(len(fLst), 4**k))
+	del mat
 
-# takes in a directory name for a directory which contains all
-# the KMC files and a file name which corresponds to the filing 
-# containing all k-mers.  
+	fillStore(options, tmpFNm, fLst, 0, k)
+
+	replaceStore(options, tmpFNm, [getGID(i) for i in fLst])
+
+# given options and list of KMC files, adds the genomes that aren't in
+# the k-mer count store to it without converting the rest again.  The
+# new store has the old rows first, then the new genomes.  If there 
+# isn't a store, a new one is made.
+def appendStore(options, fLst, k):
+	gidOrd = getStoreGIDs(options)
+	if gidOrd is None or options.rebuild:
+		makeStore(options, fLst, k)
+		return
+
+	# get the KMC files of genomes not in the store
+	have = set(gidOrd)
+	newLst = [i for i in fLst if getGID(i) not in have]
+	if len(newLst) == 0:
+		return
+	err("Adding " + str(len(newLst)) + " genomes to the k-mer count store\n")
+
+	old = np.load(options.store, mmap_mode='r')
+	if old.shape[1] != 4**k:
+		raise ValueError(options.store + ' does not hold ' + str(k) + '-mers, rerun without --update')
+
+	# copy the old rows in chunks, then convert the new genomes
+	tmpFNm = options.store + '.tmp.npy'
+	mat = np.lib.format.open_memmap(tmpFNm, mode='w+', dtype=np.uint32, shape=(len(gidOrd) + len(newLst), 4**k))
+	for i in range(0, len(gidOrd), SKETCHCHUNK):
+		mat[i:min(i + SKETCHCHUNK, len(gidOrd))] = old[i:i + SKETCHCHUNK]
+	mat.flush()
+	del mat
+	del old
+
+	fillStore(options, tmpFNm, newLst, len(gidOrd), k)
+
+	replaceStore(options, tmpFNm, gidOrd + [getGID(i) for i in newLst])
+
+# given options, the new store's temp file, and the genome IDs of its
+# rows, moves the new store and its genome IDs into place.  The old 
+# genome ID file is removed before the store is moved and the new one
+# is moved in last, so an interrupted run leaves a store without 
+# genome IDs (which is rebuilt) rather than rows that don't match 
+# their genome IDs.
+def replaceStore(options, tmpFNm, gidOrd):
+	gNm = getGIDFile(options.store)
+	f = open(gNm + '.tmp', 'w')
+	for i in gidOrd:
+		f.write(i + '\n')
+	f.close()
+
+	if os.path.exists(gNm):
+		os.remove(gNm)
+	os.rename(tmpFNm, options.store)
+	os.rename(gNm + '.tmp', gNm)
+
+# given a task (the row of the first file and a list of KMC files), 
+# converts each KMC file into its row of the k-mer count store.  The 
+# store file and k-mer size are taken from poolState, and the store is
+# memory mapped once per process.
+# returns the number of files and bytes converted
+def kmcWorker(task):
+	if 'mat' not in poolState:
+		poolState['mat'] = np.load(poolState['store'], mmap_mode='r+')
+	mat = poolState['mat']
+	k = poolState['k']
+
+	# for each file in the task
+	#   parse it
+	#   set the counts in the genome's row
+	nBytes = 0
+	for i,fNm in enumerate(task[1]):
+		kf, codes, cnts = parseKMC(fNm)
+		if kf != k and len(codes) > 0:
+			raise ValueError(fNm + ' has ' + str(kf) + '-mers, expected ' + str(k) + '-mers')
+		mat[task[0] + i,codes] = cnts
+		nBytes += os.path.getsize(fNm)
+	mat.flush()
+
+	return [len(task[1]), nBytes]
+
+# given options, k-mer count store file (already allocated), list of 
+# KMC files, the row of the first file, and k-mer size, converts each 
+# KMC file into its row of the store.  Chunks of files are spread 
+# across a pool of options.threads processes, which write straight 
+# into the store.  Progress and throughput are reported as chunks 
+# finish.
+def fillStore(options, sNm, fLst, start, k):
+	tasks = [[start + i, fLst[i:i + KMCCHUNK]] for i in range(0, len(fLst), KMCCHUNK)]
+
+	# set the state for the workers
+	poolState['store'] = sNm
+	poolState['k'] = k
+
+	# make the pool
+	pool = None
+	if options.threads <= 1 or len(tasks) <= 1:
+		results = imap(kmcWorker, tasks)
+	else:
+		pool = Pool(min(options.threads, len(tasks)))
+		results = pool.imap_unordered(kmcWorker, tasks)
+
+	# for each finished task
+	#   add to the files and bytes done
+	#   report progress about every 5% and at the end
+	err("Converting KMC (" + str(len(fLst)) + " files)...\n")
+	sTime = time.time()
+	nFiles = 0
+	nBytes = 0
+	last = 0
+	for i in results:
+		nFiles += i[0]
+		nBytes += i[1]
+		if nFiles - last >= len(fLst) / 20. or nFiles == len(fLst):
+			last = nFiles
+			secs = max(time.time() - sTime, 1e-6)
+			err('\t%d/%d files (%.1f%%), %.1f files/s, %.1f MB/s\n' % (nFiles, len(fLst), 100. * nFiles / len(fLst), nFiles / secs, nBytes / secs / 2**20))
+
+	# clean up the pool
+	if pool is not None:
+		pool.close()
+		pool.join()
+	poolState.clear()
+
+# takes in options holding the directory which contains all the KMC 
+# files and the file which contains all k-mers, and optionally the 
+# k-mer size and columns to use instead of the all k-mer file.  The 
+# k-mer count store is made if it isn't up to date (or new genomes are
+# added to it in update mode), then memory mapped.
+# returns a list containing genome order, the memory mapped store, and
+# the columns of the store with the k-mers in the all fasta KMC file
+def loadStore(options, kCols = None):
+	# get the k-mer size and columns
+	if kCols is None:
+		kCols = getKCols(options.allKMC)
+	k, cols = kCols
+
+	# get list of KMC files
+	fLst = sorted(glob(options.kmcDir + '*.kmrs'))
+
+	# convert the KMC files if needed
+	if options.update:
+		appendStore(options, fLst, k)
+	elif not checkStore(options, fLst):
+		makeStore(options, fLst, k)
+
+	store = np.load(options.store, mmap_mode='r')
+	if store.shape[1] != 4**k:
+		raise ValueError(options.store + ' does not hold ' + str(k) + '-mers, rerun with --rebuild')
+	gidOrd = getStoreGIDs(options)
+
+	return gidOrd, store, cols
+
+# takes in options holding the directory which contains all the KMC 
+# files and the file which contains all k-mers, and optionally the 
+# k-mer size and columns (see loadStore).
 # returns a list containing genome order and a matrix which rows are 
 # genomes and columns are k-mer counts
-def makeMatrix(dNm, fNm):
-	# get the k-mer index hash
-	kInd = getKInd(fNm)
+def makeMatrix(options, kCols = None):
+	gidOrd, store, cols = loadStore(options, kCols)
 
-	# get list of KMC files
-	fLst = glob(dNm + '*.kmrs')
+	# load the columns of the k-mers in the all fasta KMC file
+	err("Loading k-mer counts...\n")
+	mat = np.asarray(store[:,cols])
+
+	return gidOrd, mat
+
+# given options, the memory mapped k-mer count store, its columns to 
+# use, and optionally the rows to use (defaults to all), projects each
+# genome's k-mer counts onto options.sketchSize random gaussian 
+# directions.  Distances between sketches approximate
+# the distances between the count vectors.  Genomes are projected in
+# chunks so the counts are never all in memory.
+# returns a matrix of sketches, one row per genome
+def getSketches(options, store, cols, rows = None):
+	if rows is None:
+		rows = np.arange(store.shape[0])
+	rand = np.random.RandomState(options.seed)
+	proj = (rand.normal(size=(len(cols), options.sketchSize)) / np.sqrt(options.sketchSize)).astype(np.float32)
+	sketches = np.zeros((len(rows), options.sketchSize), dtype=np.float32)
 
-	# init the matrix and genome order 
-	mat = []
-	gidOrd = []
 	# progress bar stuff
-	err("Parsing KMC...\n\t")
-	inc = len(fLst) / 50.
+	err("Sketching genomes...\n\t")
+	chunks = range(0, len(rows), SKETCHCHUNK)
+	inc = len(chunks) / 50.
 	cnt = 0
-	# for each file in the list
-	#   get the gid
-	#   get the k-mer count array
-	#   append array to matrix
-	#   append gid to gid list
-	for i in fLst:
-		# progress bar stuff
+	# for each chunk of genomes, project their counts
+	for i in chunks:
 		if cnt >= inc:
 			cnt = 0
 			err('=')
 		cnt += 1
 
-		gid = '.'.join(os.path.basename(i).split('.')[:2])
-		arr = getKArr(fNm, kInd)
+		counts = np.asarray(store[rows[i:i + SKETCHCHUNK]][:,cols], dtype=np.float32)
+		sketches[i:i + SKETCHCHUNK] = np.dot(counts, proj)
+	err('\n')
+
+	return sketches
+
+# given the number of genomes and a genome (row) index, gets where the
+# distances from the genome to every genome after it start in the 
+# condensed distance matrix
+def getRowOffset(n, i):
+	return n * i - i * (i + 1) / 2
+
+# given the number of genomes, splits them into blocks of rows.  Each
+# block has at most DISTBLOCK distances and DISTCHUNK rows.  The 
+# distances of a block are contiguous in the condensed matrix.
+# returns a list of [first row, last row + 1]
+def getDistBlocks(n):
+	blocks = []
+	r0 = 0
+	while r0 < n - 1:
+		r1 = r0 + 1
+		pairs = n - r0 - 1
+		while r1 < n - 1 and r1 - r0 < DISTCHUNK and pairs + n - r1 - 1 <= DISTBLOCK:
+			pairs += n - r1 - 1
+			r1 += 1
+		blocks.append([r0, r1])
+		r0 = r1
+
+	return blocks
+
+# given a block index, computes the L1 distances from each of the 
+# block's genomes to every genome after it and writes them into the 
+# memory mapped distance matrix.  The matrix and blocks are taken 
+# from poolState.
+# returns the block index
+def distWorker(b):
+	mat = poolState['mat']
+	n = mat.shape[0]
+	r0, r1 = poolState['blocks'][b]
+	start = getRowOffset(n, r0)
+	out = np.empty(getRowOffset(n, r1) - start)
+
+	# for each chunk of genomes after the first row of the block
+	#   get the distances from the block's genomes to the chunk
+	#   for each genome in the block with genomes after it in the 
+	#   chunk
+	#     copy those distances to where they are in the block
+	for j0 in range(r0, n, DISTCHUNK):
+		j1 = min(n, j0 + DISTCHUNK)
+		d = cdist(mat[r0:r1], mat[j0:j1], 'cityblock')
+		for i in range(r0, min(r1, j1 - 1)):
+			s = max(j0, i + 1)
+			off = getRowOffset(n, i) + s - i - 1 - start
+			out[off:off + j1 - s] = d[i - r0, s - j0:]
+
+	dist = np.load(poolState['dist'], mmap_mode='r+')
+	dist[start:start + len(out)] = out
+	dist.flush()
+	del dist
+
+	return b
+
+# given options and the number of genomes, gets the blocks of the 
+# distance matrix that are already done.  The done file starts with a
+# line describing the store and blocks, if it doesn't match then 
+# nothing is done.
+# returns a hash of finished block indices
+def getDoneBlocks(options, head):
+	done = {}
+	doneFNm = options.dist + '.done'
+	if options.rebuild or not os.path.exists(options.dist) or not os.path.exists(doneFNm):
+		return None
+
+	f = open(doneFNm)
+	if f.readline().strip('\n') != head:
+		f.close()
+		return None
+	for i in f:
+		i = i.strip('\n')
+		# a partly written line from an interrupted run is ignored
+		if i.isdigit():
+			done[int(i)] = ''
+	f.close()
+
+	return done
+
+# given options and a matrix, computes the L1 distance between every
+# pair of rows into a memory mapped condensed distance matrix (as 
+# scipy.spatial.distance.pdist would give).  Blocks of rows are spread
+# across a pool of options.threads processes.  Each finished block is
+# recorded so an interrupted run only computes the blocks left.
+# returns the memory mapped condensed distance matrix
+def getDistances(options, mat):
+	n = mat.shape[0]
+	if n < 2:
+		raise ValueError('at least 2 genomes are needed to cluster')
+	blocks = getDistBlocks(n)
+	doneFNm = options.dist + '.done'
+	head = '\t'.join([str(n), repr(os.path.getmtime(options.store)), str(DISTBLOCK), str(DISTCHUNK)])
+
+	# start a new distance matrix if there isn't one to pick up from
+	done = getDoneBlocks(options, head)
+	if done is None:
+		done = {}
+		dist = np.lib.format.open_memmap(options.dist, mode='w+', dtype=np.float64, shape=(getRowOffset(n, n - 1),))
+		del dist
+		f = open(doneFNm, 'w')
+		f.write(head + '\n')
+		f.close()
+	todo = [i for i in range(0,len(blocks)) if i not in done]
+	err("Computing distances (" + str(len(todo)) + " of " + str(len(blocks)) + " blocks left)...\n\t")
+
+	# set the state for the workers
+	poolState['mat'] = mat
+	poolState['blocks'] = blocks
+	poolState['dist'] = options.dist
+
+	# make the pool
+	pool = None
+	if options.threads <= 1 or len(todo) <= 1:
+		results = imap(distWorker, todo)
+	else:
+		pool = Pool(min(options.threads, len(todo)))
+		results = pool.imap_unordered(distWorker, todo)
 
-		mat.append(arr)
-		gidOrd.append(gid)
 	# progress bar stuff
+	inc = len(todo) / 50.
+	cnt = 0
+	# record each block as it finishes
+	f = open(doneFNm, 'a')
+	for b in results:
+		if cnt >= inc:
+			cnt = 0
+			err('=')
+		cnt += 1
+
+		f.write(str(b) + '\n')
+		f.flush()
+	f.close()
 	err('\n')
 
-	return gidOrd, np.asarray(mat)
+	# clean up the pool
+	if pool is not None:
+		pool.close()
+		pool.join()
+	poolState.clear()
 
-# takes in a matrix and number of clusters
-# returns cluster predictions for each row in the matrix
-def getClust(mat, nClust):
-	# init the agglomerative clustering model
-	mod = AgglomerativeClustering(n_clusters=nClust, affinity='l1', linkage='average')
-	# fit and make predictions
-	pred = mod.fit_predict(mat)
+	return np.load(options.dist, mmap_mode='r')
 
-	return pred
+# given options and a matrix, builds the average linkage tree of the 
+# rows using L1 distances (from getDistances).  SciPy copies the whole
+# condensed distance matrix into memory to build the tree.  If a 
+# linkage file is given and it is newer than the k-mer count store it
+# is loaded instead.  A newly built tree is saved to the linkage file.
+# returns the linkage tree (see scipy.cluster.hierarchy.linkage)
+def getLinkage(options, mat):
+	if options.linkage != '' and not options.rebuild and os.path.exists(options.linkage) and os.path.getmtime(options.linkage) >= os.path.getmtime(options.store):
+		err("Loading linkage tree...\n")
+		tree = np.load(options.linkage)
+		if tree.shape[0] == mat.shape[0] - 1:
+			return tree
+		err("\tlinkage tree doesn't match the genomes, rebuilding\n")
+
+	dist = getDistances(options, mat)
+	err("Building linkage tree (about " + str(dist.nbytes / 2**20) + " MB of distances in memory)...\n")
+	tree = linkage(dist, method='average')
+
+	if options.linkage != '':
+		f = open(options.linkage, 'wb')
+		np.save(f, tree)
+		f.close()
+
+	return tree
+
+# given options and the number of genomes, gets the cluster counts to
+# get.  Counts larger than the number of genomes are skipped.
+# returns a list of cluster counts
+def getClustCounts(options, n):
+	clusts = [i for i in options.clusts if 0 < i <= n]
+	for i in options.clusts:
+		if i not in clusts:
+			err("warning: can't get " + str(i) + " clusters from " + str(n) + " genomes, skipping\n")
+
+	return clusts
+
+# given options, number of clusters, cluster predictions, and genome 
+# order list this writes the clusters out to a file
+def writeClusts(options, nClust, pred, gidOrd):
+	# initialize the cluster hash
+	# for each element in predictions
+	#   get the cluster number
+	#   get the gid
+	#   if the cluster not in cluster hash
+	#     add it
+	#   add gid to the cluster hash
+	cHsh = {}
+	for j in range(0,len(pred)):
+		cNum = pred[j]
+		gid = gidOrd[j]
+
+		if cNum not in cHsh:
+			cHsh[cNum] = []
+		cHsh[cNum].append(gid)
+
+	# shuffle the cluster hash for each cluster
+	for j in cHsh:
+		shuffle(cHsh[j])
+
+	# open a file and write each cluster to it
+	f = open(options.outPref + '.' + str(nClust) + '.clusts', 'w')
+	for j in cHsh:
+		f.write('\t'.join(cHsh[j]) + '\n')
+	f.close()
+
+# given options, a matrix, and genome order list this builds the 
+# linkage tree once, cuts it at each cluster count, and writes the 
+# clusters out to files
+# returns a hash that maps cluster count to its state (see 
+# getClustState)
+def getClusts(options, mat, gidOrd):
+	clusts = getClustCounts(options, len(gidOrd))
+	if len(clusts) == 0:
+		return {}
+
+	tree = getLinkage(options, mat)
+
+	# cut the tree at every cluster count at once, one column per count
+	preds = cut_tree(tree, n_clusters=clusts)
 
-# given a matrix, genome order list, and output file prefix this gets
-# clusters and writes them out to files
-def getClusts(mat, gidOrd, oPref):
 	# progress stuff
 	err("Getting clusters...\n")
 	# for each cluster to get
-	#   get predictions for the matrix
-	#   initialize the cluster hash
-	#   for each element in predictions
-	#     get the cluster number
-	#     get the gid
-	#     if the cluster not in cluster hash
-	#       add it
-	#     add gid to the cluster hash
-	#   shuffle the cluster hash for each cluster
-	#   open a file and write the first gid in each cluster to file
-	for i in clustsToGet:
+	#   write out its clusters
+	#   get its centroids for the state
+	cHsh = {}
+	for c,i in enumerate(clusts):
+		err('\t' + str(i) + '\n')
+		writeClusts(options, i, preds[:,c], gidOrd)
+		cHsh[i] = getClustState(mat, preds[:,c], i)
+
+	return cHsh
+
+# given options, a matrix of sketches, and genome order list this 
+# clusters the sketches with mini batch k-means for each cluster count
+# and writes the clusters out to files.  K-means may leave some 
+# clusters empty, so there can be fewer clusters than asked for.
+# returns a hash that maps cluster count to its state (see 
+# getClustState)
+def getApproxClusts(options, sketches, gidOrd):
+	clusts = getClustCounts(options, len(gidOrd))
+
+	# progress stuff
+	err("Getting approximate clusters...\n")
+	# for each cluster to get
+	#   fit k-means and get predictions for the sketches
+	#   write out its clusters
+	cHsh = {}
+	for i in clusts:
 		err('\t' + str(i) + '\n')
-		pred = getClust(mat, i)
+		mod = MiniBatchKMeans(n_clusters=i, batch_size=max(1024, 3 * i), n_init=3, random_state=options.seed)
+		pred = mod.fit_predict(sketches)
+		writeClusts(options, i, pred, gidOrd)
+		cHsh[i] = getClustState(sketches, pred, i)
 
-		cHsh = {}
-		for j in range(0,len(pred)):
-			cNum = pred[j]
-			gid = gidOrd[j]
+	return cHsh
 
-			if cNum not in cHsh:
-				cHsh[cNum] = []
-			cHsh[cNum].append(gid)
+# given a matrix (k-mer counts or sketches), cluster predictions, and
+# number of clusters, gets the size and centroid (mean row) of each 
+# cluster.  Empty clusters have a centroid of 0.
+# returns a hash with the predictions, sizes, and centroids
+def getClustState(mat, pred, nClust):
+	pred = np.asarray(pred, dtype=np.int64)
+	sizes = np.bincount(pred, minlength=nClust)
 
-		for j in cHsh:
-			shuffle(cHsh[j])
+	# sum the rows of each cluster with a sparse cluster x genome 
+	# membership matrix
+	member = csr_matrix((np.ones(len(pred), dtype=np.float64), (pred, np.arange(len(pred)))), shape=(nClust, len(pred)))
+	cents = np.asarray(member.dot(mat), dtype=np.float64) / np.maximum(sizes, 1)[:,None]
 
-		f = open(oPref + '.' + str(i) + '.clusts', 'w')
-		for j in cHsh:
-			f.write('\t'.join(cHsh[j]) + '\n')
-		f.close()
+	return {'pred': pred, 'sizes': sizes, 'centroids': cents.astype(np.float32)}
+
+# given options, k-mer size and columns, genome order list, and hash of
+# cluster states, saves the clustering state
+def writeState(options, kCols, gidOrd, cHsh):
+	state = {}
+	state['approx'] = options.approx
+	state['sketchSize'] = options.sketchSize
+	state['seed'] = options.seed
+	state['kCols'] = kCols
+	state['gids'] = gidOrd
+	state['clusts'] = cHsh
+
+	# write to a temp file first so a partial state is never left
+	# behind
+	tmpFNm = options.state + '.tmp'
+	f = open(tmpFNm, 'wb')
+	cPickle.dump(state, f, 2)
+	f.close()
+	os.rename(tmpFNm, options.state)
+
+# given options, reads the clustering state
+# returns the state hash
+def readState(options):
+	if not os.path.exists(options.state):
+		raise ValueError(options.state + " doesn't exist, run without --update first")
+
+	f = open(options.state, 'rb')
+	state = cPickle.load(f)
+	f.close()
+
+	return state
+
+# given options, assigns genomes that aren't in the clustering state 
+# to their nearest cluster for each cluster count.  The same distance
+# as the state's clustering is used (L1 on k-mer counts, or euclidean
+# on sketches in approximate mode).  Each centroid is moved to the 
+# mean of its old and new genomes, then the clusters are written out 
+# and the state is saved.
+def updateClusts(options):
+	state = readState(options)
+	options.approx = state['approx']
+	options.sketchSize = state['sketchSize']
+	options.seed = state['seed']
+
+	# add new genomes to the store, then find them
+	gidOrd, store, cols = loadStore(options, state['kCols'])
+	have = set(state['gids'])
+	rows = np.asarray([i for i in range(0,len(gidOrd)) if gidOrd[i] not in have], dtype=np.int64)
+	err("New genomes: " + str(len(rows)) + "\n")
+	if len(rows) == 0:
+		return
+
+	# get the k-mer counts or sketches of the new genomes
+	if options.approx:
+		feats = getSketches(options, store, cols, rows)
+		metric = 'euclidean'
+	else:
+		feats = np.asarray(store[rows][:,cols], dtype=np.float32)
+		metric = 'cityblock'
+	gids = state['gids'] + [gidOrd[i] for i in rows]
+
+	# progress stuff
+	err("Assigning genomes to clusters...\n")
+	# for each cluster count
+	#   get the nearest non-empty cluster of each new genome
+	#   move the centroids to the mean of old and new genomes
+	#   add the new predictions and write out the clusters
+	for i in sorted(state['clusts']):
+		err('\t' + str(i) + '\n')
+		c = state['clusts'][i]
+
+		dist = cdist(feats, c['centroids'], metric)
+		dist[:,c['sizes'] == 0] = np.inf
+		pred = dist.argmin(axis=1)
+
+		new = getClustState(feats, pred, i)
+		sizes = c['sizes'] + new['sizes']
+		cents = (c['centroids'] * c['sizes'][:,None] + new['centroids'] * new['sizes'][:,None]) / np.maximum(sizes, 1)[:,None]
+		c['centroids'] = cents.astype(np.float32)
+		c['sizes'] = sizes
+		c['pred'] = np.concatenate([c['pred'], new['pred']])
+
+		writeClusts(options, i, c['pred'], gids)
+
+	writeState(options, state['kCols'], gids, state['clusts'])
 
 # main driver function
 def main():
-	# get the GID order and K-mer matrix
-	gidOrd, mat = makeMatrix(argv[1], argv[2])
-	# get clusters
-	getClusts(mat, gidOrd, argv[3])
+	options, parser = getOptions()
+	# assign new genomes to the saved clusters
+	if options.update:
+		updateClusts(options)
+		return
+
+	kCols = getKCols(options.allKMC)
+	if options.approx:
+		# get the GID order and sketches, then approximate clusters
+		gidOrd, store, cols = loadStore(options, kCols)
+		sketches = getSketches(options, store, cols)
+		cHsh = getApproxClusts(options, sketches, gidOrd)
+	else:
+		# get the GID order and K-mer matrix
+		gidOrd, mat = makeMatrix(options, kCols)
+		# get clusters
+		cHsh = getClusts(options, mat, gidOrd)
+	# save the clustering state for updates
+	writeState(options, kCols, gidOrd, cHsh)
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
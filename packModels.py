@@ -0,0 +1,151 @@
+'''
+python packModels.py [-opt val] | [--opt val]
+
+Packs a directory of models into a single model bundle file.  The
+bundle holds every PLF's fold models, the attribute order, and the
+k-mer size so predict.py can load everything from one memory mapped
+file instead of opening thousands of small files.
+
+-m | --models_dir : directory containing all the models to pack
+-o | --out : model bundle file to write
+'''
+
+from sys import stderr
+import os
+import struct
+import cPickle
+from optparse import OptionParser
+from ast import literal_eval
+from glob import glob
+from predict import BUNDLEMAGIC
+
+# outputs s to stderr
+def err(s):
+	stderr.write(s)
+
+# given a directory name, cleans it so it ends with a '/'
+def cleanDir(d):
+	if d == '':
+		return d
+
+	if d[-1] != '/':
+		d += '/'
+
+	return d
+
+# grab options for the script and returns them
+def getOptions():
+	parser = OptionParser()
+
+	parser.add_option('-m', '--models_dir', help="Directory name containing all the models to pack.  Each model would be a directory named PLF_XXX_XXXXXXXX.tab", metavar="DIR", default='', dest='modelsDir')
+	parser.add_option('-o', '--out', help="Model bundle file to write", metavar="FILE", default='models.bundle', dest='outFile')
+
+	options,args = parser.parse_args()
+
+	options.modelsDir = cleanDir(options.modelsDir)
+
+	return options, parser
+
+# given a file name, reads the whole file
+# returns the contents of the file
+def readFile(fNm):
+	f = open(fNm, 'rb')
+	s = f.read()
+	f.close()
+
+	return s
+
+# given options, builds the index for the bundle.  Offsets of each
+# fold are relative to the start of the fold data.
+# returns the index hash and a list of fold file names in the order
+# they are written
+def makeIndex(options):
+	# get list of model directories
+	dLst = sorted(glob(options.modelsDir + '*.tab/'))
+
+	# the params and attribute order are shared by every model, so
+	# they are taken from the first one
+	params = readFile(dLst[0] + 'model.params')
+	attrOrder = readFile(dLst[0] + 'model.attrOrder')
+
+	index = {}
+	index['kmerSize'] = literal_eval(params.split('\n')[0])['kmerSize']
+	index['params'] = params
+	index['attrOrder'] = attrOrder
+	index['models'] = []
+
+	# progress bar stuff
+	err("Indexing models...\n\t")
+	inc = len(dLst) / 50
+	cnt = 0
+	# for each model
+	#   get the PLF ID
+	#   warn if the attribute order differs from the first model
+	#   for each fold
+	#     add the offset and size to the index
+	#     add the file to the list to write
+	fLst = []
+	offset = 0
+	for i in dLst:
+		if cnt >= inc:
+			err('=')
+			cnt = 0
+		cnt += 1
+
+		plf = os.path.basename(i[:-1]).replace('.tab', '', 1)
+		if readFile(i + 'model.attrOrder') != attrOrder:
+			err('\nwarning: attribute order of ' + plf + ' differs from ' + os.path.basename(dLst[0][:-1]) + '\n\t')
+
+		folds = []
+		for j in sorted(glob(i + 'all/model*pkl')):
+			size = os.path.getsize(j)
+			folds.append([offset, size])
+			fLst.append(j)
+			offset += size
+		index['models'].append([plf, folds])
+	err('\n')
+
+	return index, fLst
+
+# given options, an index, and list of fold files, writes the bundle
+def writeBundle(options, index, fLst):
+	idx = cPickle.dumps(index, 2)
+
+	# write to a temp file first so a partial bundle is never left
+	# behind
+	tmpFNm = options.outFile + '.tmp'
+	f = open(tmpFNm, 'wb')
+
+	# write the magic string, index length, and index
+	f.write(BUNDLEMAGIC)
+	f.write(struct.pack('<Q', len(idx)))
+	f.write(idx)
+
+	# progress bar stuff
+	err("Writing bundle...\n\t")
+	inc = len(fLst) / 50
+	cnt = 0
+	# for each fold, copy it into the bundle
+	for i in fLst:
+		if cnt >= inc:
+			err('=')
+			cnt = 0
+		cnt += 1
+
+		f.write(readFile(i))
+	err('\n')
+
+	f.close()
+	os.rename(tmpFNm, options.outFile)
+
+# main driver program
+# get options
+# index the models
+# write the bundle
+def main():
+	options, parser = getOptions()
+	index, fLst = makeIndex(options)
+	writeBundle(options, index, fLst)
+
+if __name__ == '__main__':
+	main()
@@ -8,15 +8,36 @@ Options:
   output.  Defaults to "out"
 -n | --n_plf : optional: specify the number of top PLFs to grab per 
   genome.  Defaults to 100
+-j | --jobs : optional: number of processes to parse feature tabs 
+  with.  Defaults to 1
+-s | --snapshot : optional: snapshot file of parsed feature tabs.  
+  Feature tabs whose path, size, and modified time match the snapshot
+  aren't parsed again.  Set to "" to not use one.  Defaults to 
+  "[out_pref].snapshot.pkl"
+--thresh_lo : optional: min fraction of genomes an accessory PLF is 
+  in.  Defaults to 0.1
+--thresh_hi : optional: max fraction of genomes an accessory PLF is 
+  in.  Defaults to 0.9
+-u | --update : optional: only write conserved fasta files and 
+  accessory tabs that changed since the last run, and remove those of
+  genomes and PLFs that are gone
 '''
 
 from sys import stderr
 import sys
 import os
+import cPickle
+import hashlib
 from optparse import OptionParser
 from glob import glob
-
-# set PLF conservation hi and low thresholds for accessory
+from array import array
+from itertools import imap
+from multiprocessing import Pool
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# set default PLF conservation hi and low thresholds for accessory
+# (see --thresh_lo and --thresh_hi)
 # currently set to get all genes that occur in
 #   < 90% of genomes (no conserved in accessory)
 #   > 10% of genomes (avoid "one-offs")
@@ -43,9 +64,17 @@ def getOptions():
 	parser.add_option('-g', '--gid', help="Optional: File containing genome ID list to filter off of", metavar='FILE', default='', dest='gidFNm')
 	parser.add_option('-o', '--out_pref', help="Optional: Output directory/file prefix to use.  Output will be [out_pref].acc.plf/, [out_pref].con.fasta/, [out_pref].cnts.tab", metavar="STR", default='out', dest='outPref')
 	parser.add_option('-n', '--n_plf', help="Optional: specify the number of top PLF to get per genome", metavar="INT", type=int, default=100, dest='nPLF')
+	parser.add_option('-j', '--jobs', help="Optional: number of processes to parse feature tabs with.  Defaults to 1", metavar="INT", type=int, default=1, dest='jobs')
+	parser.add_option('-s', '--snapshot', help="Optional: snapshot file of parsed feature tabs.  Feature tabs whose path, size, and modified time match the snapshot aren't parsed again.  Set to \"\" to not use one.  Defaults to [out_pref].snapshot.pkl", metavar="FILE", default=None, dest='snapshot')
+	parser.add_option('-u', '--update', help="Optional: only write conserved fasta files and accessory tabs that changed since the last run, and remove those of genomes and PLFs that are gone", action='store_true', default=False, dest='update')
+	parser.add_option('--thresh_lo', help="Optional: min fraction of genomes an accessory PLF is in.  Defaults to " + str(PLFTHRESHLO), metavar="FLOAT", type=float, default=PLFTHRESHLO, dest='threshLo')
+	parser.add_option('--thresh_hi', help="Optional: max fraction of genomes an accessory PLF is in.  Defaults to " + str(PLFTHRESHHI), metavar="FLOAT", type=float, default=PLFTHRESHHI, dest='threshHi')
 
 	options,args = parser.parse_args()
 	options.ftpDir = cleanDirNm(options.ftpDir)
+	if options.snapshot is None:
+		options.snapshot = options.outPref + '.snapshot.pkl'
+	options.state = options.outPref + '.state.pkl'
 
 	return options, parser
 
@@ -89,22 +118,68 @@ def getHeader(f):
 
 	return headHsh
 
-# given a directory for a genome, a genome ID, a hash that maps FIG 
-# IDs to PLF, hash that maps PLF to length, hash that maps FIG to 
-# length, and map that maps GID to a list of FIG
-# Returns a PLF hash of counts
-def parseGenome(dNm, gid, figPLFHsh, plfLenHsh, figLenHsh, gidFigHsh):
-	# set the GID Fig hash for the given GID
-	gidFigHsh[gid] = {}
-
+# makes an empty genome store.  Genome and PLF IDs are interned to
+# integers (their index in gids and plfNms), and each genome's 
+# features are held in compact arrays instead of per feature hashes.
+#   plfIds maps PLF ID to its index
+#   plfNms is the list of PLF IDs
+#   gids is the list of genome IDs
+#   parsed maps the genome IDs that were parsed this run (not taken 
+#   from the snapshot)
+#   plfs has an array of the PLF index of each feature per genome
+#   lens has an array of the length of each feature per genome
+#   figs has the FIG IDs of the features joined by newlines per genome
+# returns the genome store hash
+def makeGenomeStore():
+	gStore = {}
+	gStore['plfIds'] = {}
+	gStore['plfNms'] = []
+	gStore['gids'] = []
+	gStore['parsed'] = {}
+	gStore['plfs'] = []
+	gStore['lens'] = []
+	gStore['figs'] = []
+
+	return gStore
+
+# given the genome store and a PLF ID, interns the PLF ID
+# returns the index of the PLF
+def getPLFInd(gStore, plf):
+	plfIds = gStore['plfIds']
+	if plf not in plfIds:
+		plfIds[plf] = len(gStore['plfNms'])
+		gStore['plfNms'].append(plf)
+
+	return plfIds[plf]
+
+# given the genome store and the index of a genome, gets the FIG IDs 
+# of its features
+# returns a list of FIG IDs in feature order
+def getFigs(gStore, g):
+	if gStore['figs'][g] == '':
+		return []
+
+	return gStore['figs'][g].split('\n')
+
+# given a directory for a genome and a genome ID, parses the genome's
+# feature tab.  PLF IDs are interned locally to the genome so the 
+# summary is compact and can be merged into the genome store later.
+# returns a genome summary, [GID, list of the genome's PLF IDs, array
+# of the local PLF index of each feature, array of the length of each 
+# feature, FIG IDs of the features joined by newlines]
+def parseGenome(dNm, gid):
 	# open features tabular for the GID
 	f = open(dNm + gid + '.PATRIC.features.tab')
 
 	# parse header
 	headHsh = getHeader(f)
 
-	# init PLF hash
-	pHsh = {}
+	# init the genome's PLF index, length, and FIG arrays
+	plfIds = {}
+	plfNms = []
+	plfs = array('i')
+	lens = array('i')
+	figs = []
 	for i in f:
 		# strip and split line
 		i = i.strip('\n').split('\t')
@@ -117,149 +192,247 @@ def parseGenome(dNm, gid, figPLFHsh, plfLenHsh, figLenHsh, gidFigHsh):
 		if plf == '':
 			continue
 
-		# if PLF not in hash, add it and init value to 0
-		if plf not in pHsh:
-			pHsh[plf] = 0
-		# if PLF not in len hash, add it and init empty list
-		if plf not in plfLenHsh:
-			plfLenHsh[plf] = []
-		# set the FIG PLF hash
-		figPLFHsh[fig] = plf
-		# set the FIG len hash
-		figLenHsh[fig] = gLn
-		# append len to the PLF len hash
-		plfLenHsh[plf].append(gLn)
-		# increment count for PLF by 1
-		pHsh[plf] += 1
-
-		# set the gid fig hash value
-		gidFigHsh[gid][fig] = 0
+		# intern the PLF for the genome
+		if plf not in plfIds:
+			plfIds[plf] = len(plfNms)
+			plfNms.append(plf)
+
+		# add the feature
+		plfs.append(plfIds[plf])
+		lens.append(gLn)
+		figs.append(fig)
 
 	f.close()
 
-	# return plf hash
-	return pHsh
+	return [gid, plfNms, np.array(plfs, dtype=np.int32), np.array(lens, dtype=np.int32), '\n'.join(figs)]
+
+# given a genome directory, gets the genome ID
+def getDirGID(dNm):
+	return dNm.split('/')[-2]
+
+# given a genome directory, gets its feature tab file name
+def getFeatTab(dNm):
+	return dNm + getDirGID(dNm) + '.PATRIC.features.tab'
+
+# given a genome directory, parses the genome (for the worker pool)
+# returns the genome summary (see parseGenome)
+def parseWorker(dNm):
+	return parseGenome(dNm, getDirGID(dNm))
+
+# given a file name, gets the key it is stored under in the snapshot
+# returns [absolute path, size, modified time]
+def getSnapKey(fNm):
+	st = os.stat(fNm)
+
+	return [os.path.abspath(fNm), st.st_size, st.st_mtime]
+
+# given options, reads the snapshot of parsed feature tabs
+# returns a hash that maps absolute feature tab path to [size, 
+# modified time, genome summary], empty if there is no snapshot
+def readSnapshot(options):
+	if options.snapshot == '' or not os.path.exists(options.snapshot):
+		return {}
 
-# given set of options and genome ID list, parses FTP directory
-# returns a bunch of hashes
-#   PLF hash maps GID to a hash of PLFs
-#   fig PLF hash maps fig to PLF
-#   PLF len hash maps PLF to len
-#   fig len hash maps fig to len
-#   gid fig hash maps a gid to figs it has
+	err("Reading snapshot...\n")
+	f = open(options.snapshot, 'rb')
+	snap = cPickle.load(f)
+	f.close()
+
+	return snap
+
+# given options and a snapshot hash, writes the snapshot.  It is 
+# written to a temp file first so a partial snapshot is never left 
+# behind.
+def writeSnapshot(options, snap):
+	if options.snapshot == '':
+		return
+
+	err("Writing snapshot...\n")
+	tmpFNm = options.snapshot + '.tmp'
+	f = open(tmpFNm, 'wb')
+	cPickle.dump(snap, f, 2)
+	f.close()
+	os.rename(tmpFNm, options.snapshot)
+
+# given the genome store and a genome summary (from parseGenome), adds
+# the genome to the store.  The genome's PLFs are interned in the 
+# order they first appear, so merging summaries in the same order 
+# always gives the same store.
+def addGenome(gStore, summary):
+	gid, plfNms, plfs, lens, figs = summary
+
+	# map the genome's local PLF indices to store indices
+	plfMap = np.array([getPLFInd(gStore, i) for i in plfNms], dtype=np.int32)
+
+	gStore['gids'].append(gid)
+	gStore['plfs'].append(plfMap[plfs])
+	gStore['lens'].append(lens)
+	gStore['figs'].append(figs)
+
+# given set of options and genome ID list, parses FTP directory.  
+# Feature tabs in the snapshot that haven't changed are taken from it,
+# the rest are parsed across a pool of options.jobs processes.  
+# Genomes are merged into the store in directory order and the 
+# snapshot is updated if anything changed.
+# returns the genome store (see makeGenomeStore)
 def parseFTP(options, gids):
 	# get list of directories
 	dLst = getFLst(options, gids)#[:100]
 
-	# init
-	# PLF hash
-	# fig PLF hash
-	# PLF len hash
-	# fig len hash
-	# gid fig hash
-	plfHsh = {}
-	figPLFHsh = {}
-	plfLenHsh = {}
-	figLenHsh = {}
-	gidFigHsh = {}
+	# init the genome store
+	gStore = makeGenomeStore()
+
+	# for each directory
+	#   get its feature tab's key
+	#   count it if it was in the snapshot
+	#   if the snapshot has it with the same size and modified time,
+	#   keep it, otherwise it needs to be parsed
+	oldSnap = readSnapshot(options)
+	snap = {}
+	keys = []
+	todo = []
+	nOld = 0
+	for i in dLst:
+		key = getSnapKey(getFeatTab(i))
+		keys.append(key)
+		if key[0] in oldSnap:
+			nOld += 1
+		if key[0] in oldSnap and oldSnap[key[0]][:2] == key[1:]:
+			snap[key[0]] = oldSnap[key[0]]
+		else:
+			todo.append(i)
+	nNew = len(dLst) - nOld
+	nGone = len(oldSnap) - nOld
+	err("Feature tabs to parse: " + str(len(todo)) + " of " + str(len(dLst)) + "\n")
+	err("\tgenomes added since the snapshot: " + str(nNew) + ", changed: " + str(len(todo) - nNew) + ", removed: " + str(nGone) + "\n")
+
+	# make the pool, summaries come back in directory order
+	pool = None
+	if options.jobs <= 1 or len(todo) <= 1:
+		results = imap(parseWorker, todo)
+	else:
+		pool = Pool(min(options.jobs, len(todo)))
+		results = pool.imap(parseWorker, todo, max(1, len(todo) / (options.jobs * 16)))
 
 	# progress bar stuff
 	cnt = 0
 	inc = len(dLst) / 50.
 	err("Parsing feature tabs...\n\t")
-	# for each directory
-	#   get the GID
-	#   parse the genome
-	#   set the PLF hash
-	for i in dLst:
+	# for each genome
+	#   take its summary from the snapshot or the next parsed one
+	#   add it to the store
+	for key in keys:
 		# progress bar stuff
 		if cnt >= inc:
 			err('=')
 			cnt = 0
 		cnt += 1
 
-		gid = i.split('/')[-2]
-		pHsh = parseGenome(i, gid, figPLFHsh, plfLenHsh, figLenHsh, gidFigHsh)
-		plfHsh[gid] = pHsh
+		if key[0] not in snap:
+			snap[key[0]] = key[1:] + [results.next()]
+			gStore['parsed'][snap[key[0]][2][0]] = 0
+		addGenome(gStore, snap[key[0]][2])
 	err('\n')
 
-	# for each PLF in the len hash
-	#   sort the lengths
-	#   get the median and average
-	#   set the value to median and average
-	for i in plfLenHsh:
-		plfLenHsh[i].sort()
-		med = float(plfLenHsh[i][len(plfLenHsh[i])/2])
-		avg = float(sum(plfLenHsh[i])) / len(plfLenHsh[i])
+	# clean up the pool
+	if pool is not None:
+		pool.close()
+		pool.join()
 
-		plfLenHsh[i] = [med, avg]
+	# write the snapshot if genomes were parsed or removed
+	if len(todo) > 0 or len(snap) != len(oldSnap):
+		writeSnapshot(options, snap)
 
-	# return all hashes
-	return plfHsh, figPLFHsh, plfLenHsh, gidFigHsh, figLenHsh
+	return gStore
 
-# given a PLF hash
-# returns a hash of stats per PLF
-def getPLFStaHsh(plfHsh):
-	# init the stat hash
-	plfStaHsh = {}
+# given the genome store, builds a sparse genome x PLF matrix of PLF
+# counts.  Rows are in genome order and columns in PLF index order.
+# returns the count matrix (CSR)
+def makePLFMatrix(gStore):
+	nGen = len(gStore['gids'])
 
 	# progress bar stuff
-	err("Getting unique PLF list...\n\t")
+	err("Getting PLF counts...\n\t")
 	cnt = 0
-	inc = len(plfHsh) / 50.
-	# for each gid in the hash
-	#   for each PLF in the gid's hash
-	#     if the PLF not i nthe stat hash, init the stat hash
-	for i in plfHsh:
+	inc = nGen / 50.
+	# for each genome, count each of its PLFs to make its row
+	indptr = np.zeros(nGen + 1, dtype=np.int64)
+	indices = [np.zeros(0, dtype=np.int32)]
+	data = [np.zeros(0, dtype=np.int32)]
+	for i in range(0,nGen):
 		# progress bar stuff
 		if cnt >= inc:
 			err('=')
 			cnt = 0
 		cnt += 1
 
-		for j in plfHsh[i]:
-			if j not in plfStaHsh:
-				plfStaHsh[j] = []
+		plfs, cnts = np.unique(gStore['plfs'][i], return_counts=True)
+		indices.append(plfs.astype(np.int32))
+		data.append(cnts.astype(np.int32))
+		indptr[i + 1] = indptr[i] + len(plfs)
 	err('\n')
 
-	# progress bar stuff
-	err("Getting stats...\n\t")
-	cnt = 0
-	inc = len(plfStaHsh) / 50.
-	# for each PLF in the stat hash
-	#   init counts array
-	#   init presence/absence array
-	#   for each genome in the hash
-	#     check if PLF exists
-	#     if so, append 1 for pr/ab hash and count for cnts
-	#     otherwise, append 0
-	#   compute percent genomes with PLF
-	#   sort counts
-	#   compute average and median lengths
-	#   append stats to stat hash
-	for i in plfStaHsh:
-		if cnt >= inc:
-			err('=')
-			cnt = 0
-		cnt += 1
+	return csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(nGen, len(gStore['plfNms'])))
 
-		cnts = []
-		prab = []
-		for j in plfHsh:
-			if i in plfHsh[j]:
-				cnts.append(plfHsh[j][i])
-				prab.append(1)
-			else:
-				cnts.append(0)
-				prab.append(0)
-
-		pGn = float(sum(prab)) / len(prab)
-		cnts.sort()
-		avg = float(sum(cnts)) / len(cnts)
-		med = float(cnts[len(cnts)/2])
-
-		plfStaHsh[i] = [pGn, avg, med]
-	err('\n')
+# given a list of group indices (sorted), values to sort within each 
+# group (non-negative and under 2**32), and number of groups, sorts 
+# the values within each group by packing both into one key
+# returns the sorted values and the size of each group
+def sortGroups(grps, vals, nGrp):
+	key = (np.asarray(grps, dtype=np.int64) << 32) | np.asarray(vals, dtype=np.int64)
+	key.sort()
+
+	return key & 0xffffffff, np.bincount(key >> 32, minlength=nGrp)
+
+# given the genome store, gets the median and average length of each
+# PLF over every feature
+# returns an array of [median, average] per PLF index
+def getPLFLens(gStore):
+	nPLF = len(gStore['plfNms'])
+	if nPLF == 0:
+		return np.zeros((0,2))
+
+	# sort the lengths of each PLF
+	lens, n = sortGroups(np.concatenate(gStore['plfs']), np.concatenate(gStore['lens']), nPLF)
+
+	# the median is the middle length of each PLF, the average its sum
+	# over its count
+	starts = np.cumsum(n) - n
+	med = lens[starts + n / 2].astype(np.float64)
+	avg = np.add.reduceat(lens, starts).astype(np.float64) / n
+
+	return np.column_stack([med, avg])
+
+# given the genome store and the genome x PLF count matrix
+# returns a hash of stats per PLF
+def getPLFStaHsh(gStore, plfMat):
+	nGen, nPLF = plfMat.shape
+	plfNms = gStore['plfNms']
+	err("Getting stats...\n")
+
+	# column operations on the count matrix
+	#   number of genomes with each PLF (non-zero count)
+	#   average count over every genome
+	csc = plfMat.tocsc()
+	pres = np.diff(csc.indptr)
+	avg = np.asarray(csc.sum(axis=0), dtype=np.float64).ravel() / nGen
+
+	# the median count over every genome with the genomes missing the 
+	# PLF counted as 0.  The sorted counts of a PLF are its zeros 
+	# followed by its sorted non-zero counts.
+	cnts, n = sortGroups(np.repeat(np.arange(nPLF), pres), csc.data, nPLF)
+	nZero = nGen - pres
+	mid = nGen / 2
+	med = np.zeros(nPLF, dtype=np.float64)
+	hasMed = mid >= nZero
+	med[hasMed] = cnts[csc.indptr[:-1][hasMed] + mid - nZero[hasMed]]
+
+	pGn = pres.astype(np.float64) / nGen
+
+	# set stats in stat hash
+	plfStaHsh = {}
+	for i in range(0,nPLF):
+		plfStaHsh[plfNms[i]] = [float(pGn[i]), float(avg[i]), float(med[i])]
 
 	return plfStaHsh
 
@@ -281,9 +454,10 @@ def printStats(options, plfStaHsh):
 
 	f.close()
 
-# given options and hashes from parseFTP function
+# given options, stat hash, genome store, and PLF lengths (from 
+# getPLFLens)
 # returns a hash of good genomes/GIDs/figs and the top X PLFs
-def getGoodGenomes(options, plfStaHsh, gidFigHsh, figPLFHsh, figLenHsh, plfLenHsh):
+def getGoodGenomes(options, plfStaHsh, gStore, plfLens):
 	# init the top PLFs
 	topPLFs = {}
 	# for each PLF in the stat hash sorted by % conservation
@@ -300,51 +474,48 @@ def getGoodGenomes(options, plfStaHsh, gidFigHsh, figPLFHsh, figLenHsh, plfLenHs
 		if len(topPLFs) >= options.nPLF:
 			break
 
+	# flag the top PLFs and get the median length of every PLF by 
+	# index
+	isTop = np.zeros(len(gStore['plfNms']), dtype=bool)
+	for i in topPLFs:
+		isTop[gStore['plfIds'][i]] = True
+	meds = plfLens[:,0]
+
 	# initialize the good genome hash
 	gGenFighsh = {}
 
 	# progress bar stuff
 	err("Getting good GIDs\n\t")
 	cnt = 0
-	inc = len(gidFigHsh) / 50.
+	inc = len(gStore['gids']) / 50.
 	# for each genome
 	#   get the gid
-	#   create a genome FIG hash
-	#   for each fig in the PLF
-	#     get the fig ID
-	#     get the PLF for fig
-	#     init len to 0
-	#     if plf in the top
-	#       set len to len of fig
-	#     get median length of plf
-	#     if len of fig < 0.5x len or > 2x the len
-	#       continue (missing or has duplicate PLF)
-	#     set the fig for the genome
+	#   get the len of each fig, 0 if its PLF isn't in the top
+	#   get median length of each fig's plf
+	#   keep figs within 0.5x and 2x the median len (others are 
+	#   missing or have a duplicate PLF)
 	#   if genome has all figs in its hash passing the len
 	#   cutoffs, add it to the good hash
-	for i in gidFigHsh:
+	for i in range(0,len(gStore['gids'])):
 		# progress bar stuff
 		if cnt >= inc:
 			err('=')
 			cnt = 0
 		cnt += 1
 
-		gid = i
-		gFig = {}
-		for j in gidFigHsh[i]:
-			fig = j
-			plf = figPLFHsh[fig]
-
-			l = 0
-			if plf in topPLFs:
-				l = figLenHsh[fig]
+		gid = gStore['gids'][i]
+		plfs = gStore['plfs'][i]
+		l = np.where(isTop[plfs], gStore['lens'][i], 0)
+		med = meds[plfs]
+		keep = np.logical_not((l < 0.5*med) | (l > 2.0*med))
 
-			med = plfLenHsh[plf][0]
-
-			if l < 0.5*med or l > 2.0*med:
-				continue
-
-			gFig[fig] = 0
+		# figs are only looked up if there can be enough of them
+		if keep.sum() < len(topPLFs):
+			continue
+		figs = getFigs(gStore, i)
+		gFig = {}
+		for j in np.flatnonzero(keep):
+			gFig[figs[j]] = 0
 
 		if len(gFig) == len(topPLFs):
 			gGenFighsh[gid] = gFig
@@ -420,23 +591,40 @@ def writeFasta(oDir, gid, fHsh):
 	# close file
 	f.close()
 
-# given options and good genome figh hash, writes all fasta
-# files for conserved genes
-def writeFastas(options, gGenFighsh):
+# given options, good genome figh hash, genome store, and the state of
+# the last run (None if not updating), writes the fasta files for 
+# conserved genes
+# returns a hash that maps each good genome to a digest of its figs
+def writeFastas(options, gGenFighsh, gStore, state):
 	# set output directory
 	# if directory doesn't exist, make it
 	oDir = options.outPref + '.con.fasta/'
 	if not os.path.exists(oDir):
 		os.mkdir(oDir)
 
+	# get the digest of each good genome's figs
+	# if updating, only genomes that are new, were parsed again, or 
+	# whose figs changed are written
+	digests = {}
+	for i in gGenFighsh:
+		digests[i] = hashlib.sha1('\n'.join(sorted(gGenFighsh[i]))).digest()
+	gLst = gGenFighsh.keys()
+	if state is not None:
+		gLst = [i for i in gLst if state['figs'].get(i) != digests[i] or i in gStore['parsed']]
+
+		# remove fastas of genomes that are no longer good
+		for i in state['figs']:
+			if i not in gGenFighsh and os.path.exists(oDir + i + '.fasta'):
+				os.remove(oDir + i + '.fasta')
+
 	# progress bar stuff
-	err("Writing fastas...\n\t")
+	err("Writing fastas (" + str(len(gLst)) + " of " + str(len(gGenFighsh)) + ")...\n\t")
 	cnt = 0
-	inc = len(gGenFighsh) / 50.
-	# for each good genome
+	inc = len(gLst) / 50.
+	# for each good genome to write
 	#   parse the fasta file for the genome
 	#   write the fasta file for the genome
-	for i in gGenFighsh:
+	for i in gLst:
 		# progress bar stuff
 		if cnt >= inc:
 			err('=')
@@ -447,86 +635,113 @@ def writeFastas(options, gGenFighsh):
 		writeFasta(oDir, i, fHsh)
 	err('\n')
 
-# given a plf stat hash, good genome fig hahs, and plf hash
-# table of PLFs for training
-def makePLFTabHsh(plfStaHsh, gGenFighsh, plfHsh):
-	# init stat table for plfs
-	plfTabHsh = {}
+	return digests
 
-	# progress bar stuff
-	err("Getting accessory PLF labels...\n\t")
-	inc = len(plfStaHsh) / 50.
-	cnt = 0
-	# for each PLF in stat hash
-	#   if PLF outside threshold, continue
-	#   if PLF not in hash, add it with additional label 0
-	#   else add it with additional label 1
-	for i in plfStaHsh:
-		if cnt >= inc:
-			cnt = 0
-			err('=')
-		cnt += 1
+# given options, a plf stat hash, good genome fig hash, genome store, and
+# the genome x PLF count matrix
+# returns the list of good genomes and a hash that maps each accessory
+# PLF to an array of its labels (1 if present, 0 if absent) for the 
+# good genomes in order
+def makePLFTabHsh(options, plfStaHsh, gGenFighsh, gStore, plfMat):
+	err("Getting accessory PLF labels...\n")
 
-		if plfStaHsh[i][0] > PLFTHRESHHI or plfStaHsh[i][0] < PLFTHRESHLO:
-			continue
-		plfTabHsh[i] = []
-		for j in gGenFighsh:
-			if i not in plfHsh[j]:
-				plfTabHsh[i].append([j, '0'])
-			else:
-				plfTabHsh[i].append([j, '1'])
-	err('\n')
+	# get the accessory PLFs, those within the thresholds
+	accPLFs = [i for i in plfStaHsh if options.threshLo <= plfStaHsh[i][0] <= options.threshHi]
+	cols = np.asarray([gStore['plfIds'][i] for i in accPLFs], dtype=np.int64)
 
-	# dLst = []
-	# for i in plfTabHsh:
-	# 	cnt = [0,0]
-	# 	for j in plfTabHsh[i]:
-	# 		if j[1] == '1':
-	# 			cnt[1] += 1
-	# 		if j[1] == '0':
-	# 			cnt[0] += 1
-	# 	if cnt[0] == 0 and cnt[1] == 0:
-	# 		dLst.append(plfTabHsh)
+	# get the good genomes in store order
+	gInds = np.asarray([i for i in range(0,len(gStore['gids'])) if gStore['gids'][i] in gGenFighsh], dtype=np.int64)
+	gidOrd = [gStore['gids'][i] for i in gInds]
 
-	# for i in dLst:
-	# 	del plfTabHsh[i]
+	# labels are the presence of the accessory PLF columns in the good
+	# genome rows
+	labs = (plfMat[gInds][:,cols] > 0).astype(np.uint8).toarray()
+
+	# get the labels for each accessory PLF
+	plfTabHsh = {}
+	for j,i in enumerate(accPLFs):
+		plfTabHsh[i] = labs[:,j]
 
-	return plfTabHsh
+	return gidOrd, plfTabHsh
 
-# given output name and table prints table to file
-def printPLFTab(oFNm, tab):
+# given output name, list of genomes, and their labels prints table to
+# file
+def printPLFTab(oFNm, gidOrd, labs):
 	f = open(oFNm, 'w')
 
-	for i in tab:
-		f.write('\t'.join(i) + '\n')
+	for i in range(0,len(gidOrd)):
+		f.write(gidOrd[i] + '\t' + str(labs[i]) + '\n')
 
 	f.close()
 
-# given options and plfTabHsh, outputs presence/absence table per PLF
-def printPLFTabHsh(options, plfTabHsh):
+# given options, list of good genomes, plfTabHsh, and the state of the
+# last run (None if not updating), outputs presence/absence table per 
+# PLF
+# returns a hash that maps each accessory PLF to a digest of its table
+def printPLFTabHsh(options, gidOrd, plfTabHsh, state):
 	# set output directory
 	# if not exists, make directory
 	oDir = options.outPref + '.acc.tabs/'
 	if not os.path.exists(oDir):
 		os.mkdir(oDir)
 
+	# get the digest of each table from the genomes and labels
+	# if updating, only tables that changed are written
+	gDigest = hashlib.sha1('\n'.join(gidOrd)).digest()
+	digests = {}
+	for i in plfTabHsh:
+		digests[i] = hashlib.sha1(gDigest + np.ascontiguousarray(plfTabHsh[i]).tostring()).digest()
+	pLst = plfTabHsh.keys()
+	if state is not None:
+		pLst = [i for i in pLst if state['tabs'].get(i) != digests[i]]
+
+		# remove tables of PLFs that are no longer accessory
+		for i in state['tabs']:
+			if i not in plfTabHsh and os.path.exists(oDir + i + '.tab'):
+				os.remove(oDir + i + '.tab')
+
 	# progress bar stuff
-	err("Writing accessory PLF tabs...\n\t")
-	inc = len(plfTabHsh) / 50.
+	err("Writing accessory PLF tabs (" + str(len(pLst)) + " of " + str(len(plfTabHsh)) + ")...\n\t")
+	inc = len(pLst) / 50.
 	cnt = 0
-	# for each PLF in table hash
+	# for each PLF to write
 	#   set output file name
 	#   print table to file
-	for i in plfTabHsh:
+	for i in pLst:
 		if cnt >= inc:
 			cnt = 0
 			err('=')
 		cnt += 1
 
 		oFNm = oDir + i + '.tab'
-		printPLFTab(oFNm, plfTabHsh[i])
+		printPLFTab(oFNm, gidOrd, plfTabHsh[i])
 	err('\n')
 
+	return digests
+
+# given options, reads the state of the last run
+# returns the state hash, or None if there isn't one
+def readState(options):
+	if not os.path.exists(options.state):
+		return None
+
+	f = open(options.state, 'rb')
+	state = cPickle.load(f)
+	f.close()
+
+	return state
+
+# given options and digests of the fasta files and accessory tables 
+# that were written, saves the state of the run for updates.  It is 
+# written to a temp file first so a partial state is never left 
+# behind.
+def writeState(options, figs, tabs):
+	tmpFNm = options.state + '.tmp'
+	f = open(tmpFNm, 'wb')
+	cPickle.dump({'figs': figs, 'tabs': tabs}, f, 2)
+	f.close()
+	os.rename(tmpFNm, options.state)
+
 # given options and a list of top PLFs, prints them to a file
 def printTopPLFs(options, topPLFs):
 	oFNm = options.outPref + '.plf.con.lst'
@@ -541,36 +756,51 @@ def printTopPLFs(options, topPLFs):
 # parse options
 # get GIDs
 #
-# parse the FTP to ge ta bunch of hashes
+# parse the FTP into the genome store
 #
+# make the genome x PLF count matrix
 # get the stats for PLFs
 # print the stats to file
 # 
-# get good genomes
+# get the PLF lengths and good genomes
 # 
 # print top PLFs to file
 #
+# get the state of the last run if updating
 # write conserved fasta files
 #
 # make the PLF tab hash for accessories to train on
 # print the tabular files
+# save the state for the next update
 def main():
 	options, parser = getOptions()
 	gids = getGIDLst(options.gidFNm)
 
-	plfHsh,figPLFHsh,plfLenHsh,gidFigHsh, figLenHsh = parseFTP(options, gids)
+	gStore = parseFTP(options, gids)
 
-	plfStaHsh = getPLFStaHsh(plfHsh)
+	plfMat = makePLFMatrix(gStore)
+	plfStaHsh = getPLFStaHsh(gStore, plfMat)
 	printStats(options, plfStaHsh)
 
-	gGenFighsh, topPLFs = getGoodGenomes(options, plfStaHsh, gidFigHsh, figPLFHsh, figLenHsh, plfLenHsh)
+	plfLens = getPLFLens(gStore)
+	gGenFighsh, topPLFs = getGoodGenomes(options, plfStaHsh, gStore, plfLens)
 
 	printTopPLFs(options, topPLFs)
 
-	writeFastas(options, gGenFighsh)
+	# if updating, get the state of the last run
+	# without one, everything is written
+	state = None
+	if options.update:
+		state = readState(options)
+		if state is None:
+			err("warning: no state at " + options.state + ", writing everything\n")
+
+	figs = writeFastas(options, gGenFighsh, gStore, state)
+
+	gidOrd, plfTabHsh = makePLFTabHsh(options, plfStaHsh, gGenFighsh, gStore, plfMat)
+	tabs = printPLFTabHsh(options, gidOrd, plfTabHsh, state)
 
-	plfTabHsh = makePLFTabHsh(plfStaHsh, gGenFighsh, plfHsh)
-	printPLFTabHsh(options, plfTabHsh)
+	writeState(options, figs, tabs)
 	
 if __name__ == '__main__':
 	main()
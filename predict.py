@@ -1,21 +1,79 @@
 '''
 python predict.py [-opt val] | [--opt val]
 
--f | --feature_tab : feature tabular file from an annotated genome on BVBRC
+-f | --feature_tab : feature tabular file from an annotated genome on BVBRC.  Can be gzip (.gz) or bzip2 (.bz2) compressed, or "-" to read from stdin
+-b | --batch : directory of feature tabular files or a file listing feature tabular files (one per line) to predict on in a single run.  Feature tabs are read in parallel by a pool of processes when using more than 1 thread.  Overrides -f
 -p | --cons_plfs : list of conserved PLFs used to train the model
--m | --models : directory containing all the models which will be predicted on
--t | --temp_dir : Temporary directory used to hold fasta files, KMC output, etc.  This directory may get cleared when running the script.  Defaults to "temp/"
+-m | --models : directory containing all the models which will be predicted on, or a model bundle file made by packModels.py
+-l | --plfs : only predict on these PLFs.  Either a comma separated list of PLF IDs or a file listing them (one per line).  Defaults to every PLF
+-t | --temp_dir : Temporary directory used to hold fasta files and KMC output when using KMC.  Each run makes its own private directory inside of it which is removed when the run finishes.  Nothing is written when counting k-mers in process.  Defaults to "temp/"
+-k | --kmer_counter : k-mer counter to use, either "numpy" (in process) or "kmc" (runs kmc.sh).  Defaults to "numpy"
+-n | --threads : number of threads to predict with.  Models are spread across a pool of this many workers.  Defaults to 1
+--pool : type of worker pool to use, either "thread" or "process".  Defaults to "thread"
+-e | --engine : inference engine, either "xgb" (XGBoost boosters) or "numpy" (all trees are converted to arrays and evaluated in batches).  Defaults to "xgb"
+-c | --cache_dir : directory to cache predictions in.  Genomes with the same conserved gene k-mer counts and models are only predicted on once.  Defaults to no cache
+--cache_size : max size of the cache in MB.  Least recently used predictions are removed past this size.  Defaults to 1024
+--profile : file to write a JSON report of the wall time, CPU time, and peak memory of each stage to
+--early_exit : evaluate folds one at a time and stop once the remaining folds can't change the prediction.  Adds a column with the number of folds evaluated.  Only used by the xgb engine
+-o | --out_file : file to write the predictions to.  Defaults to standard output
+--out_format : format of the predictions, either "tsv", "jsonl", "parquet", or "arrow" (Arrow IPC stream).  Rows are written as each PLF finishes.  Parquet and Arrow need pyarrow.  Defaults to "tsv"
 '''
 
 from sys import stderr
 import sys
+import gzip
+import bz2
 from optparse import OptionParser
 import os
 from ast import literal_eval
 import shutil
+import tempfile
+import subprocess
+import mmap
+import struct
+import cPickle
+import json
+import hashlib
+import time
+import resource
 from glob import glob
+from itertools import imap
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import xgboost as xgb
 
+# pyarrow is only needed for the parquet and arrow output formats
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+# state shared with the prediction worker pool.  It is set before the 
+# pool is made so process workers inherit it when they are forked.
+poolState = {}
+
+# timings of each stage for the profile report.  Model loading and
+# inference are summed over every model by predAll.
+profile = {'stages': [], 'modelLoad': 0.0, 'inference': 0.0}
+
+# model bundles that have been opened, keyed by file name
+bundles = {}
+
+# magic string at the start of a model bundle file
+BUNDLEMAGIC = 'PLFBUNDL'
+
+# number of models converted into each forest by the numpy engine, and
+# the max number of genome x tree cells evaluated at once
+FORESTCHUNK = 64
+FORESTCELLS = 2**22
+
+# number of rows buffered before they are written as one parquet row 
+# group or arrow record batch
+OUTCHUNK = 65536
+
 # outputs s to stderr
 def err(s):
 	stderr.write(s)
@@ -67,21 +125,122 @@ def cleanDir(d):
 def getOptions():
 	parser = OptionParser()
 
-	parser.add_option('-f', '--feature_tab', help="Feature tabular file from the annotated genome to predict on", metavar="FILE", default='', dest="featFile")
+	parser.add_option('-f', '--feature_tab', help="Feature tabular file from the annotated genome to predict on.  Can be gzip (.gz) or bzip2 (.bz2) compressed, or - to read from stdin", metavar="FILE", default='', dest="featFile")
+	parser.add_option('-b', '--batch', help="Directory of feature tabular files or a file listing feature tabular files, one per line, to predict on in a single run.  Overrides -f", metavar="DIR|FILE", default='', dest="batch")
 	parser.add_option('-p', '--cons_plfs', help="List of conserved PLFs that the model is based off of.", metavar='FILE', default='', dest='conPLFFile')
-	parser.add_option('-m', '--models_dir', help="Directory name containing all the models to preedict with.  Each model would be a directory named PLF_XXX_XXXXXXXX.tab", metavar="DIR", default='', dest='modelsDir')
-	parser.add_option('-t', '--temp_dir', help="Directory name to be used as a temporary directory for temporary files and other things", metavar="DIR", default='temp/', dest='tempDir')
+	parser.add_option('-m', '--models_dir', help="Directory name containing all the models to preedict with.  Each model would be a directory named PLF_XXX_XXXXXXXX.tab.  Can also be a model bundle file made by packModels.py", metavar="DIR", default='', dest='modelsDir')
+	parser.add_option('-l', '--plfs', help="Only predict on these PLFs.  Either a comma separated list of PLF IDs or a file listing them, one per line.  Defaults to every PLF", metavar="STR|FILE", default='', dest='plfs')
+	parser.add_option('-t', '--temp_dir', help="Directory name to be used as a temporary directory for fasta files and KMC output when using KMC.  Each run makes its own private directory inside of it", metavar="DIR", default='temp/', dest='tempDir')
+	parser.add_option('-k', '--kmer_counter', help="K-mer counter to use, either numpy (in process) or kmc (runs kmc.sh).  Defaults to numpy", type='choice', choices=['numpy', 'kmc'], metavar="STR", default='numpy', dest='kmerCounter')
+	parser.add_option('-n', '--threads', help="Number of threads to predict with.  Models are spread across a pool of this many workers.  Defaults to 1", metavar="INT", type=int, default=1, dest='threads')
+	parser.add_option('--pool', help="Type of worker pool to use, either thread or process.  Defaults to thread", type='choice', choices=['thread', 'process'], metavar="STR", default='thread', dest='poolType')
+	parser.add_option('-e', '--engine', help="Inference engine, either xgb (XGBoost boosters) or numpy (all trees are converted to arrays and evaluated in batches).  Defaults to xgb", type='choice', choices=['xgb', 'numpy'], metavar="STR", default='xgb', dest='engine')
+	parser.add_option('--early_exit', help="Evaluate folds one at a time and stop once the remaining folds can't change the prediction.  Adds a column with the number of folds evaluated.  Only used by the xgb engine", action='store_true', default=False, dest='earlyExit')
+	parser.add_option('-c', '--cache_dir', help="Directory to cache predictions in.  Genomes with the same conserved gene k-mer counts and models are only predicted on once.  Defaults to no cache", metavar="DIR", default='', dest='cacheDir')
+	parser.add_option('--profile', help="File to write a JSON report of the wall time, CPU time, and peak memory of each stage to", metavar="FILE", default='', dest='profile')
+	parser.add_option('-o', '--out_file', help="File to write the predictions to.  Defaults to standard output", metavar="FILE", default='', dest='outFile')
+	parser.add_option('--out_format', help="Format of the predictions, either tsv, jsonl, parquet, or arrow (Arrow IPC stream).  Parquet and arrow need pyarrow.  Defaults to tsv", type='choice', choices=['tsv', 'jsonl', 'parquet', 'arrow'], metavar="STR", default='tsv', dest='outFormat')
+	parser.add_option('--cache_size', help="Max size of the cache in MB.  Least recently used predictions are removed past this size.  Defaults to 1024", metavar="INT", type=int, default=1024, dest='cacheSize')
 
 	options,args = parser.parse_args()
 
-	options.modelsDir = cleanDir(options.modelsDir)
+	if options.outFormat in ['parquet', 'arrow'] and pa is None:
+		parser.error('pyarrow is needed for the ' + options.outFormat + ' output format')
+
+	setModelsDir(options)
+	setPLFs(options)
 	options.tempDir = cleanDir(options.tempDir)
+	options.cacheDir = cleanDir(options.cacheDir)
 
-	options.fastaFile = os.path.basename(options.featFile).replace('.txt','.fasta', 1)
+	return options, parser
 
-	makeDir(options.tempDir, True)
+# given options, sets up the models directory.  If it is a model 
+# bundle file, options.bundle is set to the file name, otherwise it 
+# is set to ''.
+def setModelsDir(options):
+	options.bundle = ''
+	if os.path.isfile(options.modelsDir):
+		options.bundle = options.modelsDir
+	else:
+		options.modelsDir = cleanDir(options.modelsDir)
+
+# given options (after setModelsDir), sets the PLFs to predict on.  
+# Each PLF is looked up in the bundle index or as a model directory 
+# named after it, so the models directory is never listed.  PLFs 
+# without a model are skipped with a warning.
+# options.plfs is set to the sorted list of PLF IDs, empty for every 
+# PLF
+def setPLFs(options):
+	# get the list of PLFs, either from a file or the option itself
+	if options.plfs == '':
+		options.plfs = []
+		return
+	elif os.path.isfile(options.plfs):
+		f = open(options.plfs)
+		plfs = [i.strip() for i in f]
+		f.close()
+	else:
+		plfs = [i.strip() for i in options.plfs.split(',')]
+	plfs = sorted(set([i for i in plfs if i != '']))
+
+	# for each PLF, keep it if it has a model
+	options.plfs = []
+	missing = []
+	for i in plfs:
+		if options.bundle != '':
+			found = i in openBundle(options.bundle)['plfs']
+		else:
+			found = os.path.isdir(options.modelsDir + i + '.tab/')
+		if found:
+			options.plfs.append(i)
+		else:
+			missing.append(i)
+
+	if len(missing) > 0:
+		err('warning: no model found for ' + ', '.join(missing) + '\n')
+	if len(options.plfs) == 0:
+		raise ValueError('none of the PLFs given have a model')
+
+# given options, gets the directory of the first model to read the 
+# params and attribute order from.  If PLFs were selected the first of
+# them is used.
+# returns the model directory name
+def getFirstModelDir(options):
+	if len(options.plfs) > 0:
+		return options.modelsDir + options.plfs[0] + '.tab/'
+
+	return glob(options.modelsDir + '*.tab/')[0]
+
+# given a model bundle file name, opens and memory maps it.  Each 
+# bundle is only opened once.
+#
+# The bundle is laid out as:
+#   the magic string
+#   length of the index (8 byte unsigned little endian)
+#   the index, a pickled hash
+#   every model fold one after the other
+#
+# returns a hash with the memory map, index, where the model folds
+# start, and a hash that maps PLF ID to its folds
+def openBundle(fNm):
+	if fNm in bundles:
+		return bundles[fNm]
+
+	# open and map the file
+	f = open(fNm, 'rb')
+	mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	f.close()
 
-	return options, parser
+	# check the magic string, then read the index
+	if mm[:len(BUNDLEMAGIC)] != BUNDLEMAGIC:
+		raise ValueError(fNm + ' is not a model bundle')
+	start = len(BUNDLEMAGIC) + 8
+	idxLen = struct.unpack('<Q', mm[len(BUNDLEMAGIC):start])[0]
+	index = cPickle.loads(mm[start:start + idxLen])
+
+	bundles[fNm] = {'mm': mm, 'index': index, 'data': start + idxLen, 'plfs': dict(index['models'])}
+
+	return bundles[fNm]
 
 # given options, gets the list of conserved genes
 def getConPLFs(options):
@@ -112,49 +271,167 @@ def parseHeader(f):
 
 	return headHsh
 
-# given options and conserved genes parses the feature file
-# for the genome and extracts the conserved PLFs and nucleotide
+# given options, gets the list of feature tabular files to predict on
+# returns a list of [genome name, feature file, fasta file name]
+def getGenomes(options):
+	# if not in batch mode, only the one feature file is predicted on
+	if options.batch == '':
+		fLst = [options.featFile]
+	# if batch is a directory, get all files in it
+	elif os.path.isdir(options.batch):
+		fLst = sorted([i for i in glob(cleanDir(options.batch) + '*') if os.path.isfile(i)])
+	# otherwise batch is a file listing the feature files
+	else:
+		f = open(options.batch)
+		fLst = []
+		for i in f:
+			i = i.strip()
+			if i != '':
+				fLst.append(i)
+		f.close()
+
+	# for each feature file
+	#   set the genome name to the file name without extension
+	#   set a unique fasta file name for the temp directory
+	genomes = []
+	for i in range(0,len(fLst)):
+		gNm = os.path.basename(fLst[i])
+		for j in ['.gz', '.bz2', '.txt']:
+			if gNm.endswith(j):
+				gNm = gNm[:-len(j)]
+		fastaFile = str(i) + '.' + gNm + '.fasta'
+		genomes.append([gNm, fLst[i], fastaFile])
+
+	return genomes
+
+# given a hash of figs and a default name, gets the genome ID
+# from the fig IDs (fig|562.1234.peg.1 -> 562.1234)
+# returns the genome ID or the default if it can't be found
+def getGID(gFigHsh, default):
+	for i in gFigHsh:
+		arr = i.split('|')
+		if len(arr) < 2:
+			break
+		arr = arr[1].split('.')
+		if len(arr) < 4:
+			break
+		return '.'.join(arr[:2])
+
+	return default
+
+# given a feature file name, opens it for reading.  Files ending in
+# .gz or .bz2 are decompressed as they are read and "-" is stdin.
+# returns the file stream
+def openFeatures(fNm):
+	if fNm == '-':
+		return sys.stdin
+	elif fNm.endswith('.gz'):
+		return gzip.open(fNm, 'rb')
+	elif fNm.endswith('.bz2'):
+		return bz2.BZ2File(fNm, 'r')
+	else:
+		return open(fNm)
+
+# given a feature file name and conserved genes parses the feature 
+# file for the genome and extracts the conserved PLFs and nucleotide
 # sequences for the given genome.
 # returns a hash that maps conserved figs to their sequences
-def parseFeatures(options, cPLFHsh):
+def parseFeatures(fNm, cPLFHsh):
 	# open the feature file
-	f = open(options.featFile)
+	f = openFeatures(fNm)
+	# parse it
+	gFigHsh = parseFeatureStream(f, cPLFHsh)
+	if f is not sys.stdin:
+		f.close()
 
+	return gFigHsh
+
+# given a tuple of feature file name and conserved genes, parses the 
+# feature file.  Used by the worker pool in getConsSeqs.
+# returns a hash that maps conserved figs to their sequences
+def parseWorker(args):
+	return parseFeatures(args[0], args[1])
+
+# given an open feature file stream and conserved genes, extracts the
+# conserved PLFs and nucleotide sequences for the genome.  Lines are
+# only split as far as the fig and PLF columns, the rest of the line 
+# is only split for conserved PLFs to get the sequence.
+# returns a hash that maps conserved figs to their sequences
+def parseFeatureStream(f, cPLFHsh):
 	# get the header setup
 	headHsh = parseHeader(f)
+	figInd = headHsh['feature_id']
+	plfInd = headHsh['plfam']
+	seqInd = headHsh['nucleotide_sequence']
+	# number of columns to split off of the front of each line
+	nHead = max(figInd, plfInd) + 1
+	# number of columns a line needs, the rest of the line is only 
+	# needed if the sequence isn't in the front
+	nNeed = max(nHead, min(seqInd, nHead) + 1)
+
 	# init the hash
 	gFigHsh = {}
 	# for each line in the file
-	#   split the line
-	#   get the fig
+	#   split the front of the line
+	#   skip short (truncated) lines
 	#   get the PLF
-	#   get the nucl seq
-	#   if the plf is one of the conserved ones
-	#     add to hash
+	#   if the plf isn't one of the conserved ones, skip it
+	#   get the fig
+	#   get the nucl seq, splitting the rest of the line if needed
+	#   add to hash
 	for i in f:
-		i = i.strip('\n').split('\t')
-		figID = i[headHsh['feature_id']]
-		plfam = i[headHsh['plfam']]
-		dnaSe = i[headHsh['nucleotide_sequence']]
-
-		if plfam in cPLFHsh:
-			gFigHsh[figID] = dnaSe
+		i = i.split('\t', nHead)
+		if len(i) < nNeed:
+			continue
+		plfam = i[plfInd].rstrip('\r\n')
+		if plfam not in cPLFHsh:
+			continue
 
-	f.close()
+		figID = i[figInd].rstrip('\r\n')
+		if seqInd < nHead:
+			dnaSe = i[seqInd]
+		else:
+			rest = i[nHead].split('\t', seqInd - nHead + 1)
+			if len(rest) <= seqInd - nHead:
+				continue
+			dnaSe = rest[seqInd - nHead]
+		gFigHsh[figID] = dnaSe.rstrip('\r\n')
 
 	return gFigHsh
 
-# given options, creates a fasta of conserved genes (which was 
-# trained on) and writes it to a file
-def makeConsFastaFile(options):
+# given options and list of genomes (from getGenomes), parses the 
+# conserved gene sequences for every genome.  In batch mode, the
+# genome name is replaced by the genome ID found in the feature file.
+# returns a list of hashes that map conserved figs to their sequences
+def getConsSeqs(options, genomes):
 	# get the cosnerved genes
 	cPLFHsh = getConPLFs(options)
-	# parse the feature tabular file for the cosnerved genes and
-	# sequences
-	gFigHsh = parseFeatures(options, cPLFHsh)
 
+	# parse the feature tabular files for the conserved genes and 
+	# sequences, in parallel if there is more than one thread and 
+	# genome.  Parsing is CPU bound, so a process pool is always used.
+	args = [[i[1], cPLFHsh] for i in genomes]
+	nPool = max(1, min(options.threads, len(genomes)))
+	if nPool == 1:
+		seqLst = map(parseWorker, args)
+	else:
+		pool = Pool(nPool)
+		seqLst = pool.map(parseWorker, args)
+		pool.close()
+		pool.join()
+
+	# if in batch mode, set the genome IDs
+	if options.batch != '':
+		for i in range(0,len(genomes)):
+			genomes[i][0] = getGID(seqLst[i], genomes[i][0])
+
+	return seqLst
+
+# given options, a hash of conserved figs to sequences (which was 
+# trained on), and a fasta file name, writes the fasta file
+def makeConsFastaFile(options, gFigHsh, fastaFile):
 	# open file
-	f = open(options.tempDir + os.path.basename(options.fastaFile), 'w')
+	f = open(options.tempDir + fastaFile, 'w')
 
 	# for each element in the hash, write it in fasta file
 	for i in gFigHsh:
@@ -165,8 +442,12 @@ def makeConsFastaFile(options):
 
 # given options, finds the k-mer size used to train the models
 def getK(options):
+	# bundles store the k-mer size in their index
+	if options.bundle != '':
+		return openBundle(options.bundle)['index']['kmerSize']
+
 	# get the first model trained
-	dNm = glob(options.modelsDir + '*.tab/')[0]
+	dNm = getFirstModelDir(options)
 
 	# open params model
 	# reads line
@@ -181,21 +462,26 @@ def getK(options):
 	# return the k-mer size
 	return hsh['kmerSize']
 
-# given options and k-mer size, runs KMC
-def runKMC(options, k):
+# given options, k-mer size, and fasta file name, runs KMC
+def runKMC(options, k, fastaFile):
 	# create command to run KMC
-	cmdArr = ['kmc.sh', str(k), options.tempDir + os.path.basename(options.fastaFile), options.tempDir + os.path.basename(options.fastaFile), options.tempDir,  '1', '> /dev/null']
-	cmd = ' '.join(cmdArr)
+	cmdArr = ['kmc.sh', str(k), options.tempDir + fastaFile, options.tempDir + fastaFile, options.tempDir]
 
-	# run KMC
-	os.system(cmd)
-
-	# create command to delete intermediate KMC output
-	cmdArr = ['rm', options.tempDir + os.path.basename(options.fastaFile) + '.kmc_*']
-	cmd = ' '.join(cmdArr)
+	# run KMC, throwing away its output
+	devNull = open(os.devnull, 'w')
+	subprocess.call(cmdArr, stdout=devNull)
+	devNull.close()
 
 	# remove intermediate KMC output
-	os.system(cmd)
+	for i in glob(options.tempDir + fastaFile + '.kmc_*'):
+		os.remove(i)
+
+# given options, makes a private temp directory for this run inside of
+# the temp directory so concurrent runs never clobber each other.  
+# options.tempDir is set to the private directory.
+def makeRunTempDir(options):
+	makeDir(options.tempDir, False)
+	options.tempDir = cleanDir(tempfile.mkdtemp(prefix='predict.', dir=options.tempDir))
 
 # given a file name, parses the KMC file
 # returns hash that maps k-mer to count
@@ -216,84 +502,601 @@ def parseKMC(fNm):
 
 	return kHsh
 
+# gets the lookup table for 2-bit encoding nucleotides.  A, C, G, T 
+# (either case) are 0-3, anything else is 4
+# returns an array indexed by character code
+def getNuclTab():
+	tab = np.full(256, 4, dtype=np.uint8)
+	for i,c in enumerate('ACGT'):
+		tab[ord(c)] = i
+		tab[ord(c.lower())] = i
+
+	return tab
+
+# given a list of sequences and k-mer size, counts canonical k-mers
+# the same way as KMC does (the smaller of a k-mer and its reverse
+# complement is counted, k-mers with non-ACGT bases are skipped, and 
+# counts are capped at the -cs value used by kmc.sh).  
+# returns an array of counts indexed by 2-bit encoded k-mer
+def countKmers(seqs, k):
+	# join the sequences with an N so no k-mer spans two genes
+	# encode the sequence
+	seq = 'N'.join(seqs)
+
+	# number of k-mers in the sequence
+	n = len(seq) - k + 1
+	if n <= 0:
+		return np.zeros(4**k, dtype=np.int64)
+
+	codes = getNuclTab()[np.frombuffer(seq, dtype=np.uint8)]
+
+	# a k-mer is valid if there are no bad bases in its window
+	bad = np.concatenate([[0], np.cumsum(codes > 3)])
+	valid = (bad[k:] - bad[:-k]) == 0
+
+	# build the forward and reverse complement encodings of every 
+	# k-mer one base at a time
+	codes = codes.astype(np.int64) & 3
+	fwd = np.zeros(n, dtype=np.int64)
+	rev = np.zeros(n, dtype=np.int64)
+	for i in range(0,k):
+		c = codes[i:i+n]
+		fwd = (fwd << 2) | c
+		rev |= (3 - c) << (2*i)
+
+	# count the canonical k-mers
+	canon = np.minimum(fwd, rev)[valid]
+	counts = np.bincount(canon, minlength=4**k)
+	counts = np.minimum(counts, 1677215)
+
+	return counts
+
+# given an attribute order hash (from getAttrOrder) and k-mer size, 
+# gets the 2-bit encoding of every k-mer attribute
+# returns an array of column indices and an array of k-mer codes
+def getAttrCodes(attrOrder, k):
+	tab = getNuclTab()
+
+	# for each attribute
+	#   skip it if it isn't a k-mer
+	#   encode the k-mer
+	cols = []
+	codes = []
+	for i in attrOrder:
+		if len(i) != k:
+			continue
+		arr = tab[np.frombuffer(i, dtype=np.uint8)]
+		if (arr > 3).any():
+			continue
+		code = 0
+		for j in arr:
+			code = (code << 2) | int(j)
+		cols.append(attrOrder[i])
+		codes.append(code)
+
+	return np.asarray(cols, dtype=np.int64), np.asarray(codes, dtype=np.int64)
+
 # given options, gets the order of features for train/prediction
 # matrix.  
 # returns hash that maps feature to index
 def getAttrOrder(options):
+	# bundles store the attribute order file in their index
+	if options.bundle != '':
+		return parseAttrOrder(openBundle(options.bundle)['index']['attrOrder'].splitlines())
+
 	# get the first model trained
-	dNm = glob(options.modelsDir + '*.tab/')[0]
+	dNm = getFirstModelDir(options)
 
 	# open attribute order file
 	f = open(dNm + 'model.attrOrder')
+	attrOrder = parseAttrOrder(f)
+	f.close()
+
+	return attrOrder
 
+# given the lines of an attribute order file, parses them
+# returns hash that maps feature to index
+def parseAttrOrder(lns):
 	# init the hash
 	attrOrder = {}
 	# for each line, split then add to hash
-	for i in f:
+	for i in lns:
 		i = i.strip('\n').split('\t')
 		attrOrder[i[0]] = int(i[1])
 
-	f.close()
-
 	return attrOrder
 
-# given options and k-mer size, creates a matrix to predict with
-# returns a DMatrix to predict XGB models
-def makeMatrix(options, k):
-	# parse the KMC file
-	kHsh = parseKMC(options.tempDir + os.path.basename(options.fastaFile) + '.' + str(k) + '.kmrs')
-	# get attribute order
-	attrOrder = getAttrOrder(options)
-
-	# init the array
-	arr = [0] * len(attrOrder)
-
-	# for each k-mer in the hash
-	#   if the k-mer is not in the features list
-	#     continue
-	#   get the index number for the feature
-	#   set array appropriately
-	for i in kHsh:
-		if i not in attrOrder:
-			continue
-		ind = attrOrder[i]
-		arr[ind] = kHsh[i]
+# given options, k-mer size, list of genomes, list of conserved 
+# sequence hashes (from getConsSeqs), and optionally an already parsed
+# attribute order, creates a matrix to predict with.  K-mers are 
+# either counted in process or read from the KMC output.  There is one
+# row per genome in genome order.
+# returns a matrix of k-mer counts
+def makeMatrix(options, k, genomes, seqLst, attrOrder = None):
+	# get attribute order if it wasn't given
+	if attrOrder is None:
+		attrOrder = getAttrOrder(options)
+
+	# init the matrix
+	mat = np.zeros((len(genomes), len(attrOrder)), dtype=np.float32)
+
+	# if counting in process
+	#   get the code for each k-mer feature
+	#   for each genome
+	#     count the k-mers
+	#     set the row from the counts
+	if options.kmerCounter == 'numpy':
+		cols, codes = getAttrCodes(attrOrder, k)
+		for i in range(0,len(genomes)):
+			counts = countKmers(seqLst[i].values(), k)
+			mat[i,cols] = counts[codes]
+	# otherwise
+	#   for each genome
+	#     parse the KMC file
+	#     for each k-mer in the hash
+	#       if the k-mer is not in the features list
+	#         continue
+	#       get the index number for the feature
+	#       set array appropriately
+	else:
+		for i in range(0,len(genomes)):
+			kHsh = parseKMC(options.tempDir + genomes[i][2] + '.' + str(k) + '.kmrs')
+			for j in kHsh:
+				if j not in attrOrder:
+					continue
+				mat[i,attrOrder[j]] = kHsh[j]
+
+	return mat
+
+# given options, gets the list of models to predict with
+# returns a list of [PLF ID, model directory].  For bundles the model 
+# directory is replaced by a hash with the bundle file name and where
+# each fold is in the bundle.  If PLFs were selected, only they are 
+# listed.
+def getModelLst(options):
+	# bundles store the model list in their index
+	if options.bundle != '':
+		bundle = openBundle(options.bundle)
+		if len(options.plfs) > 0:
+			models = [[i, bundle['plfs'][i]] for i in options.plfs]
+		else:
+			models = bundle['index']['models']
+		mLst = []
+		for i in models:
+			mLst.append([i[0], {'bundle': options.bundle, 'folds': i[1]}])
+		return mLst
+
+	# get list of model directories, only the selected ones if given
+	if len(options.plfs) > 0:
+		dLst = [options.modelsDir + i + '.tab/' for i in options.plfs]
+	else:
+		dLst = sorted(glob(options.modelsDir + '*.tab/'))
 
-	# convert the array to a DMatrix
-	dMat = xgb.DMatrix([arr])
+	# for each model directory, get the PLF ID
+	mLst = []
+	for i in dLst:
+		plf = os.path.basename(i[:-1]).replace('.tab', '', 1)
+		mLst.append([plf, i])
+
+	return mLst
 
-	return dMat
+# given a directory name for a model (or a bundle hash from 
+# getModelLst) and number of threads, loads each of its folds
+# returns a list of boosters
+def loadPLF(dNm, nthread = 1):
+	# load from the bundle if given one
+	if isinstance(dNm, dict):
+		return loadBundlePLF(dNm, nthread)
 
-# given a DMatrix and directory name for a model predicts the
-# presence/absence of the gene from the model for the genome
-# returns a set of predictions.
-def predPLF(dMat, dNm):
 	# get list of folds to predict with
-	mLst = glob(dNm + 'all/model*pkl')
+	mLst = sorted(glob(dNm + 'all/model*pkl'))
 
-	# array to hold predictions
-	preds = []
+	# array to hold the folds
+	mods = []
 	# for each fold
 	#   load the model
-	#   set threads to 1
-	#   make prediction
+	#   set threads
 	#   append to array
 	for i in mLst:
 		mod = xgb.Booster(model_file=i)
-		mod.set_param('njobs', 1)
+		mod.set_param('nthread', nthread)
+		mods.append(mod)
+
+	return mods
+
+# given a bundle hash from getModelLst and number of threads, loads
+# each of the model's folds from the memory mapped bundle
+# returns a list of boosters
+def loadBundlePLF(bHsh, nthread = 1):
+	bundle = openBundle(bHsh['bundle'])
+	mm = bundle['mm']
+
+	# for each fold
+	#   get where the fold is in the bundle
+	#   load the model from the bytes
+	#   set threads
+	#   append to array
+	mods = []
+	for i in bHsh['folds']:
+		start = bundle['data'] + i[0]
+		mod = xgb.Booster()
+		mod.load_model(bytearray(mm[start:start + i[1]]))
+		mod.set_param('nthread', nthread)
+		mods.append(mod)
+
+	return mods
+
+# given options, loads every model so they can be kept in memory
+# returns a list of [PLF ID, list of boosters]
+def loadModels(options):
+	mLst = getModelLst(options)
+
+	# progress bar stuff
+	err("Loading PLF models...\n\t")
+	inc = len(mLst) / 50
+	cnt = 0
+	# for each model, load the boosters for its folds
+	models = []
+	for i in mLst:
+		if cnt >= inc:
+			err('=')
+			cnt = 0
+		cnt += 1
+
+		models.append([i[0], loadPLF(i[1])])
+	err('\n')
+
+	return models
+
+# given a DMatrix, either a directory name for a model or a list of
+# already loaded boosters, number of threads per booster, and early 
+# exit flag, predicts the presence/absence of the gene from the model
+# for every genome (row) in the matrix.  Each fold is only loaded 
+# once.  
+# returns a set of predictions, one array per fold with one value per
+# genome.
+def predPLF(dMat, mods, nthread = 1, early = False):
+	# load the folds if given a directory or bundle hash
+	if not isinstance(mods, list):
+		mods = loadPLF(mods, nthread)
+
+	# early exit is done separately
+	if early:
+		return predPLFEarly(dMat, mods, nthread)
+
+	# array to hold predictions
+	preds = []
+	# for each fold
+	#   set threads
+	#   make prediction
+	#   append to array
+	for mod in mods:
+		mod.set_param('nthread', nthread)
 		pred = mod.predict(dMat)
-		preds.append(pred[0])
+		preds.append(pred)
+
+	return preds
+
+# given a DMatrix, list of boosters, and number of threads per 
+# booster, predicts with one fold at a time.  After each fold, genomes
+# whose prediction can't be changed by the remaining folds (even if 
+# they all predict 0 or 1) are dropped.
+# returns a set of predictions, one array per fold with one value per
+# genome.  Genomes the fold wasn't evaluated on are NaN.
+def predPLFEarly(dMat, mods, nthread = 1):
+	nFold = len(mods)
+	nRow = dMat.num_row()
+
+	# init the predictions, sums, and genomes left to predict on
+	preds = [np.full(nRow, np.nan) for i in mods]
+	sums = np.zeros(nRow)
+	rows = np.arange(nRow)
+	sub = dMat
+	# for each fold
+	#   make prediction for remaining genomes
+	#   get the lowest and highest the mean could end up at
+	#   keep genomes where the label could still change
+	#   stop if there are none left
+	for i in range(0,nFold):
+		mods[i].set_param('nthread', nthread)
+		pred = mods[i].predict(sub)
+		preds[i][rows] = pred
+		sums[rows] += pred
+
+		lo = sums[rows] / nFold
+		hi = (sums[rows] + nFold - i - 1) / nFold
+		keep = getLabInd(lo) != getLabInd(hi)
+		rows = rows[keep]
+		if len(rows) == 0:
+			break
+		if not keep.all():
+			sub = dMat.slice(rows)
+
+	return preds
+
+# given the index of a model in the pool state, predicts with it.  
+# Used by the worker pool in predAll.  The DMatrix is made once per
+# worker process (or once overall for threads).
+# returns the set of predictions from predPLF, the time spent loading
+# the model, and the time spent predicting
+def predWorker(i):
+	if poolState['dMat'] is None:
+		poolState['dMat'] = xgb.DMatrix(poolState['mat'])
+
+	# load the model if it isn't already
+	sTime = time.time()
+	mods = poolState['models'][i][1]
+	if not isinstance(mods, list):
+		mods = loadPLF(mods, poolState['nthread'])
+	lTime = time.time()
+
+	preds = predPLF(poolState['dMat'], mods, poolState['nthread'], poolState['early'])
+
+	return [preds, lTime - sTime, time.time() - lTime]
+
+# given a tree dumped as JSON by XGBoost and the flat node arrays of a
+# forest, appends every node of the tree to the arrays.  Leaves point
+# to themselves so they stay put while the tree is traversed.
+# returns the index of the root node and the depth of the tree
+def addTree(tree, nodes):
+	# give every node in the tree its index in the arrays
+	# walk the tree to get every node and its depth
+	stack = [[tree, 0]]
+	nLst = []
+	nInd = {}
+	depth = 0
+	while len(stack) > 0:
+		node, d = stack.pop()
+		nInd[node['nodeid']] = len(nodes['feat']) + len(nLst)
+		nLst.append(node)
+		depth = max(depth, d)
+		for i in node.get('children', []):
+			stack.append([i, d + 1])
+
+	# for each node
+	#   if it's a leaf, set the leaf value and point to itself
+	#   otherwise set the split and children
+	for node in nLst:
+		ind = nInd[node['nodeid']]
+		if 'leaf' in node:
+			nodes['feat'].append(0)
+			nodes['thr'].append(0.0)
+			nodes['yes'].append(ind)
+			nodes['no'].append(ind)
+			nodes['miss'].append(ind)
+			nodes['leaf'].append(node['leaf'])
+		else:
+			nodes['feat'].append(int(node['split'][1:]))
+			nodes['thr'].append(node['split_condition'])
+			nodes['yes'].append(nInd[node['yes']])
+			nodes['no'].append(nInd[node['no']])
+			nodes['miss'].append(nInd[node['missing']])
+			nodes['leaf'].append(0.0)
+
+	return nInd[tree['nodeid']], depth
+
+# given a list of models (from getModelLst or loadModels), converts
+# every tree of every fold into one forest of flat arrays (feature 
+# index, threshold, children, leaf value).  Trees of a fold are next 
+# to each other.  Each fold's base margin is read from its config.
+# returns a hash holding the forest
+def makeForest(models):
+	nodes = {'feat': [], 'thr': [], 'yes': [], 'no': [], 'miss': [], 'leaf': []}
+	roots = []
+	foldStart = []
+	nFolds = []
+	depth = 0
+	base = []
+
+	# for each model
+	#   load the folds
+	#   for each fold
+	#     for each tree in the fold
+	#       add the tree
+	for i in models:
+		mods = i[1]
+		if not isinstance(mods, list):
+			mods = loadPLF(mods)
+		nFolds.append(len(mods))
+		for mod in mods:
+			foldStart.append(len(roots))
+			base.append(getBaseMargin(mod))
+			for tree in mod.get_dump(dump_format='json'):
+				root, d = addTree(json.loads(tree), nodes)
+				roots.append(root)
+				depth = max(depth, d)
+	foldStart.append(len(roots))
+
+	forest = {}
+	forest['feat'] = np.asarray(nodes['feat'], dtype=np.int32)
+	forest['thr'] = np.asarray(nodes['thr'], dtype=np.float32)
+	forest['yes'] = np.asarray(nodes['yes'], dtype=np.int32)
+	forest['no'] = np.asarray(nodes['no'], dtype=np.int32)
+	forest['miss'] = np.asarray(nodes['miss'], dtype=np.int32)
+	forest['leaf'] = np.asarray(nodes['leaf'], dtype=np.float32)
+	forest['roots'] = np.asarray(roots, dtype=np.int32)
+	forest['foldStart'] = np.asarray(foldStart, dtype=np.int64)
+	forest['nFolds'] = nFolds
+	forest['depth'] = depth
+	forest['base'] = np.asarray(base, dtype=np.float64)
+
+	return forest
+
+# given a booster, gets its base margin from the base score in its 
+# config and makes sure it is a binary:logistic model
+# returns the base margin
+def getBaseMargin(mod):
+	config = json.loads(mod.save_config())
+	if config['learner']['objective']['name'] != 'binary:logistic':
+		raise ValueError('numpy engine only supports binary:logistic models')
+	# newer versions of XGBoost write the base score as a list
+	base = float(config['learner']['learner_model_param']['base_score'].strip('[]'))
+
+	return np.log(base / (1.0 - base))
+
+# given the cache directory, fingerprint of the models, and a chunk of
+# models, gets the file the chunk's forest is saved to
+# returns the file name
+def getForestFNm(cacheDir, mPrint, models):
+	key = hashlib.sha1(mPrint + '\n'.join([i[0] for i in models])).hexdigest()
+
+	return cacheDir + key + '.forest.npz'
+
+# given a forest file name, reads the saved forest.  The file is 
+# touched so it is the most recently used.
+# returns the forest or None if it isn't saved
+def readForest(fNm):
+	try:
+		f = open(fNm, 'rb')
+		npz = np.load(f)
+		forest = dict([[i, npz[i]] for i in npz.files])
+		f.close()
+		os.utime(fNm, None)
+	except (IOError, OSError, ValueError):
+		return None
+
+	forest['nFolds'] = forest['nFolds'].tolist()
+	forest['depth'] = int(forest['depth'])
+
+	return forest
+
+# given a forest file name and forest, saves the forest.  A temp file
+# is written then renamed so other runs never see a partial file.
+def writeForest(fNm, forest):
+	tmpFNm = fNm + '.' + str(os.getpid()) + '.tmp'
+
+	f = open(tmpFNm, 'wb')
+	np.savez(f, **forest)
+	f.close()
+	os.rename(tmpFNm, fNm)
+
+# given a list of models, converts the models to forests, FORESTCHUNK
+# models at a time
+# returns a list of forests
+def makeForests(models):
+	forests = []
+	for i in range(0,len(models),FORESTCHUNK):
+		forests.append(makeForest(models[i:i + FORESTCHUNK]))
+
+	return forests
+
+# given a forest and k-mer count matrix, traverses every tree for 
+# every genome.  Trees are evaluated in batches of whole folds so no 
+# more than about FORESTCELLS genome x tree cells are held at once.
+# returns a matrix of margins (without base margin) with one row per
+# genome and one column per fold
+def evalForestMargins(forest, mat):
+	mat = np.asarray(mat, dtype=np.float32)
+	nRow = mat.shape[0]
+	foldStart = forest['foldStart']
+	nFold = len(foldStart) - 1
+	margins = np.zeros((nRow, nFold), dtype=np.float64)
+	rows = np.arange(nRow)[:,None]
+
+	# for each batch of folds
+	#   get the roots of the trees in the batch for every genome
+	#   move every genome down every tree one level at a time
+	#   sum the leaves reached for each fold (folds without trees 
+	#   are left at 0)
+	f0 = 0
+	while f0 < nFold:
+		f1 = f0 + 1
+		while f1 < nFold and (foldStart[f1 + 1] - foldStart[f0]) * nRow <= FORESTCELLS:
+			f1 += 1
+		t0 = foldStart[f0]
+		t1 = foldStart[f1]
+		if t1 > t0:
+			node = np.tile(forest['roots'][t0:t1], (nRow, 1))
+			for d in range(0,forest['depth']):
+				x = mat[rows, forest['feat'][node]]
+				nxt = np.where(x < forest['thr'][node], forest['yes'][node], forest['no'][node])
+				node = np.where(np.isnan(x), forest['miss'][node], nxt)
+			vals = forest['leaf'][node].astype(np.float64)
+
+			cSum = np.zeros((nRow, t1 - t0 + 1), dtype=np.float64)
+			np.cumsum(vals, axis=1, out=cSum[:,1:])
+			margins[:,f0:f1] = cSum[:,foldStart[f0 + 1:f1 + 1] - t0] - cSum[:,foldStart[f0:f1] - t0]
+		f0 = f1
+
+	return margins
+
+# given a forest and k-mer count matrix, predicts with every fold of
+# every model in the forest
+# returns a list with the set of predictions for each model, the same
+# as predPLF would give
+def evalForest(forest, mat):
+	margins = evalForestMargins(forest, mat) + forest['base']
+	probs = 1.0 / (1.0 + np.exp(-margins))
+
+	# split the folds by model
+	preds = []
+	ind = 0
+	for i in forest['nFolds']:
+		preds.append([probs[:,j] for j in range(ind, ind + i)])
+		ind += i
 
 	return preds
 
-# given an array of predictions converts to prediction string
+# given the index of a chunk of models in the pool state, predicts 
+# with it using the numpy engine.  Used by the worker pool in predAll.
+# The chunk is either a forest or the start and end of a range of 
+# models that is converted to a forest first.  If there is a cache 
+# directory, converted forests are saved to it and read back on later
+# runs.
+# returns a list with the set of predictions for each model, the time
+# spent loading and converting the models, and the time spent 
+# predicting
+def forestWorker(i):
+	sTime = time.time()
+	forest = poolState['chunks'][i]
+	if not isinstance(forest, dict):
+		models = poolState['models'][forest[0]:forest[1]]
+		if poolState['forestPrint'] is None:
+			forest = makeForest(models)
+		else:
+			fNm = getForestFNm(poolState['cacheDir'], poolState['forestPrint'], models)
+			forest = readForest(fNm)
+			if forest is None:
+				forest = makeForest(models)
+				writeForest(fNm, forest)
+	lTime = time.time()
+
+	preds = evalForest(forest, poolState['mat'])
+
+	return [preds, lTime - sTime, time.time() - lTime]
+
+# given results from the worker pool and whether each result has 
+# predictions for many models, adds the load and predict times of each
+# result to the profile
+# yields the set of predictions for each model in order
+def addTimes(results, many):
+	for i in results:
+		profile['modelLoad'] += i[1]
+		profile['inference'] += i[2]
+		if many:
+			for j in i[0]:
+				yield j
+		else:
+			yield i[0]
+
+# given an array of mean predictions, gets the index of the label 
+# convPredArr would give (N, N*, Y*, none, Y)
+# returns an array of label indices
+def getLabInd(s):
+	return np.where(s < 0.33, 0, np.where(s < 0.5, 1, np.where(s < 0.66, 2, np.where(s > 0.66, 4, 3))))
+
+# given an array of predictions and optionally the total number of 
+# folds, converts to prediction string.  If only some of the folds 
+# were evaluated (early exit), the mean is taken over all folds.
 #   N = strong absence
 #   N* = weak absence
 #   Y = strong presence
 #   Y* = weak presence
 # returns prediction string
-def convPredArr(pArr):
-	s = sum(pArr) / float(len(pArr))
+def convPredArr(pArr, nFold = None):
+	if nFold is None:
+		nFold = len(pArr)
+	s = sum(pArr) / float(nFold)
 
 	sLab = ''
 	if s < 0.33:
@@ -307,62 +1110,499 @@ def convPredArr(pArr):
 
 	return sLab
 
-# given options and a DMatrix, predicts on all models
-# returns a table of predictions
-def predAll(options, dMat):
-	# get list of models
-	dLst = glob(options.modelsDir + '*.tab/')
+# given options, a k-mer count matrix, list of genomes, and optionally
+# the list of models from loadModels and forests from makeForests, 
+# predicts on all models.  Models (or chunks of models for the numpy
+# engine) are spread across a pool of options.threads workers, any 
+# threads left over go to each booster.  Results are in model order no
+# matter how many workers are used.  If given an emit function, the 
+# rows of each model are passed to it as soon as the model finishes 
+# instead of being kept.
+# Each row is [genome ID, PLF ID, label, list of fold predictions] 
+# where folds that weren't evaluated (early exit) are NaN.
+# returns a table of predictions with one row per genome and PLF, 
+# grouped by genome (empty if emitting)
+def predAll(options, mat, genomes, models = None, forests = None, emit = None):
+	# get list of models if they weren't preloaded
+	if models is None:
+		models = getModelLst(options)
+
+	# get the tasks for the workers
+	# numpy engine works on forests or chunks of models
+	if options.engine == 'numpy':
+		worker = forestWorker
+		if forests is not None:
+			poolState['chunks'] = forests
+		else:
+			poolState['chunks'] = [[i, i + FORESTCHUNK] for i in range(0,len(models),FORESTCHUNK)]
+		nTask = len(poolState['chunks'])
+	else:
+		worker = predWorker
+		nTask = len(models)
+
+	# get the pool size and threads per booster
+	nPool = max(1, min(options.threads, nTask))
+	nthread = max(1, options.threads / nPool)
+
+	# set the state for the workers
+	# process workers make their own DMatrix
+	poolState['mat'] = mat
+	poolState['models'] = models
+	poolState['nthread'] = nthread
+	poolState['early'] = options.earlyExit and options.engine == 'xgb'
+	poolState['dMat'] = None
+	poolState['forestPrint'] = None
+	if options.engine == 'numpy' and forests is None and options.cacheDir != '':
+		poolState['cacheDir'] = options.cacheDir
+		poolState['forestPrint'] = getModelPrint(options, models)
+	if options.engine == 'xgb' and (nPool == 1 or options.poolType == 'thread'):
+		poolState['dMat'] = xgb.DMatrix(mat)
+
+	# make the pool and get the predictions in model order
+	pool = None
+	if nPool == 1:
+		results = imap(worker, range(0,nTask))
+	elif options.poolType == 'thread':
+		pool = ThreadPool(nPool)
+		results = pool.imap(worker, range(0,nTask))
+	else:
+		pool = Pool(nPool)
+		results = pool.imap(worker, range(0,nTask), max(1, nTask / (nPool * 16)))
 
-	# init predictions
-	preds = []
+	# add worker times to the profile
+	# numpy engine gives predictions for many models per task
+	results = addTimes(results, options.engine == 'numpy')
+
+	# init predictions, one list per genome
+	preds = [[] for i in genomes]
 	# progress bar stuff
 	err("Making PLF predictions...\n\t")
-	inc = len(dLst) / 50
+	inc = len(models) / 50
 	cnt = 0
 	# for each model
 	#   get PLF ID
-	#   make predictions for model
-	#   get the string label for the fold
-	#   append to table of predictions
-	for i in dLst:
+	#   get predictions for model
+	#   for each genome
+	#     get the fold predictions for the genome
+	#     get the string label from the folds that were evaluated
+	#     add the row
+	#   emit the rows or append them to the table of predictions
+	for i,foldArr in enumerate(results):
 		if cnt >= inc:
 			err('=')
 			cnt = 0
 		cnt += 1
 
-		plf = os.path.basename(i[:-1]).replace('.tab', '', 1)
-		predArr = predPLF(dMat, i)
-		sLab = convPredArr(predArr)
-		preds.append([plf, sLab, str(sum(predArr))])
+		plf = models[i][0]
+		rows = []
+		for j in range(0,len(genomes)):
+			folds = [p[j] for p in foldArr]
+			predArr = [p for p in folds if not np.isnan(p)]
+			sLab = convPredArr(predArr, len(folds))
+			rows.append([genomes[j][0], plf, sLab, folds])
+
+		if emit is not None:
+			emit(rows)
+		else:
+			for j in range(0,len(genomes)):
+				preds[j].append(rows[j])
 	err('\n')
 
+	# clean up the pool
+	if pool is not None:
+		pool.close()
+		pool.join()
+	poolState.clear()
+
+	# flatten the table so rows are grouped by genome
+	preds = [j for i in preds for j in i]
+
+	return preds
+
+# given a file name, gets its path, size, and modified time for a 
+# fingerprint
+# returns the fingerprint line
+def getFilePrint(fNm):
+	try:
+		st = os.stat(fNm)
+	except OSError:
+		return os.path.abspath(fNm) + '\tmissing\n'
+
+	return '\t'.join([os.path.abspath(fNm), str(st.st_size), str(st.st_mtime)]) + '\n'
+
+# given options and the list of models, gets a fingerprint of the 
+# models.  For a bundle this is its path, size, and modified time.  For
+# a directory it is the path, size, and modified time of each model's 
+# fold files, attribute order, and params.  Options that change the 
+# output are included as well.
+# returns the fingerprint string
+def getModelPrint(options, models):
+	h = hashlib.sha1()
+	# rows hold the fold predictions, older caches only had their sum
+	h.update('folds\n')
+	h.update(options.engine + '\t' + str(options.earlyExit) + '\n')
+
+	if options.bundle != '':
+		h.update(getFilePrint(options.bundle))
+		h.update('\t'.join(options.plfs) + '\n')
+	else:
+		for i in models:
+			for j in sorted(glob(i[1] + 'all/model*pkl')) + [i[1] + 'model.attrOrder', i[1] + 'model.params']:
+				h.update(getFilePrint(j))
+
+	return h.hexdigest()
+
+# given options and a cache key, reads the cached predictions.  The
+# file is touched so it is the most recently used.
+# returns the cached table of predictions (without genome column) or
+# None if the key isn't cached
+def readCache(options, key):
+	fNm = options.cacheDir + key + '.pkl'
+	try:
+		f = open(fNm, 'rb')
+		preds = cPickle.load(f)
+		f.close()
+		os.utime(fNm, None)
+	except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+		return None
+
 	return preds
 
-# given table of predictions, prints them
-def printPreds(preds):
-	# create and output header
-	arr = ['PLFam', 'Prediction']
-	print '\t'.join(arr)
-	# for each prediction, print it
-	for i in preds:
-		print '\t'.join(i)
+# given options, a cache key, and table of predictions (without 
+# genome column), writes the predictions to the cache.  A temp file 
+# is written then renamed so other runs never see a partial file.
+def writeCache(options, key, preds):
+	fNm = options.cacheDir + key + '.pkl'
+	tmpFNm = fNm + '.' + str(os.getpid()) + '.tmp'
+
+	f = open(tmpFNm, 'wb')
+	cPickle.dump(preds, f, 2)
+	f.close()
+	os.rename(tmpFNm, fNm)
+
+# given options, removes the least recently used predictions and 
+# forests from the cache until it is under the max size
+def evictCache(options):
+	# get the size and last use of each cached file
+	fLst = []
+	total = 0
+	for i in glob(options.cacheDir + '*.pkl') + glob(options.cacheDir + '*.forest.npz'):
+		try:
+			st = os.stat(i)
+		except OSError:
+			continue
+		fLst.append([st.st_mtime, st.st_size, i])
+		total += st.st_size
+
+	# remove oldest files until under the max size
+	fLst.sort()
+	maxSize = options.cacheSize * 1024 * 1024
+	for i in fLst:
+		if total <= maxSize:
+			break
+		try:
+			os.remove(i[2])
+		except OSError:
+			pass
+		total -= i[1]
+
+# given options, a k-mer count matrix, list of genomes, and emit 
+# function, predicts on all models and passes the rows to emit.  If a
+# cache directory is set, genomes whose k-mer counts were already 
+# predicted on with the same models are read from the cache and 
+# emitted first, then the rest are predicted on.
+def predCached(options, mat, genomes, emit):
+	if options.cacheDir == '':
+		predAll(options, mat, genomes, emit=emit)
+		return
+
+	makeDir(options.cacheDir, False)
+	models = getModelLst(options)
+	mPrint = getModelPrint(options, models)
+
+	# for each genome
+	#   get the key from the models and k-mer counts
+	#   read the cached predictions
+	#   emit them (putting the genome column back on) if cached
+	keys = []
+	cached = []
+	for i in range(0,len(genomes)):
+		key = hashlib.sha1(mPrint + np.ascontiguousarray(mat[i], dtype=np.float32).tostring()).hexdigest()
+		keys.append(key)
+		cached.append(readCache(options, key))
+		if cached[i] is not None:
+			emit([[genomes[i][0]] + j for j in cached[i]])
+
+	# predict on genomes that weren't cached
+	# rows are kept per genome (without the genome column) as they are
+	# emitted, then written to the cache
+	miss = [i for i in range(0,len(genomes)) if cached[i] is None]
+	err("Cached predictions: " + str(len(genomes) - len(miss)) + " of " + str(len(genomes)) + "\n")
+	if len(miss) > 0:
+		missPreds = [[] for i in miss]
+		def emitMiss(rows):
+			for j in range(0,len(rows)):
+				missPreds[j].append(rows[j][1:])
+			emit(rows)
+
+		predAll(options, mat[miss], [genomes[i] for i in miss], models, emit=emitMiss)
+		for j in range(0,len(miss)):
+			writeCache(options, keys[miss[j]], missPreds[j])
+		evictCache(options)
+
+# gets the CPU time used so far by this process and its children 
+# (KMC) in seconds
+def getCPUTime():
+	cpu = 0.0
+	for i in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+		r = resource.getrusage(i)
+		cpu += r.ru_utime + r.ru_stime
+
+	return cpu
+
+# resets the peak memory of this process so the peak of the next 
+# stage can be read.  Only supported on Linux.
+# returns True if the peak was reset
+def resetPeakRSS():
+	try:
+		f = open('/proc/self/clear_refs', 'w')
+		f.write('5')
+		f.close()
+	except (IOError, OSError):
+		return False
+
+	return True
+
+# gets the peak memory (KB) of this process since it was last reset.
+# If it can't be read, the peak of the whole process so far is used.
+# returns the peak memory
+def getPeakRSS():
+	try:
+		f = open('/proc/self/status')
+		for i in f:
+			if i.startswith('VmHWM:'):
+				f.close()
+				return int(i.split()[1])
+		f.close()
+	except (IOError, OSError):
+		pass
+
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# given a stage name, function, and arguments, runs the function and
+# adds the wall time, CPU time, and peak memory (KB) of the stage to 
+# the profile.  If the peak memory can't be reset before the stage,
+# the peak of the whole process so far is given and maxRSSScope is 
+# set to process instead of stage.  The peak memory of child 
+# processes (KMC) is the largest of any child so far.
+# returns what the function returns
+def timeStage(name, func, *args):
+	scope = 'stage' if resetPeakRSS() else 'process'
+	sWall = time.time()
+	sCPU = getCPUTime()
+
+	ret = func(*args)
+
+	stage = {}
+	stage['stage'] = name
+	stage['wall'] = time.time() - sWall
+	stage['cpu'] = getCPUTime() - sCPU
+	stage['maxRSS'] = getPeakRSS()
+	stage['maxRSSScope'] = scope
+	stage['maxRSSChildrenSoFar'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	profile['stages'].append(stage)
+
+	return ret
+
+# given options and list of genomes, writes the profile to a JSON file
+# if one was asked for
+def writeProfile(options, genomes):
+	if options.profile == '':
+		return
+
+	report = {}
+	report['genomes'] = len(genomes)
+	report['threads'] = options.threads
+	report['pool'] = options.poolType
+	report['engine'] = options.engine
+	report['kmerCounter'] = options.kmerCounter
+	report['stages'] = profile['stages']
+	report['wall'] = sum([i['wall'] for i in profile['stages']])
+	report['cpu'] = sum([i['cpu'] for i in profile['stages']])
+	report['maxRSS'] = max([i['maxRSS'] for i in profile['stages']])
+	# summed over all models, so with more than one worker these can 
+	# be more than the wall time of the predict stage
+	report['modelLoad'] = profile['modelLoad']
+	report['inference'] = profile['inference']
+
+	f = open(options.profile, 'w')
+	json.dump(report, f, indent=1, sort_keys=True)
+	f.write('\n')
+	f.close()
+
+# given options, k-mer size, list of genomes, and list of conserved 
+# sequence hashes, makes the conserved fasta files and runs KMC on them
+def runKMCAll(options, k, genomes, seqLst):
+	for i in range(0,len(genomes)):
+		makeConsFastaFile(options, seqLst[i], genomes[i][2])
+		runKMC(options, k, genomes[i][2])
+
+# given options and a row of the prediction table, gets the row as it
+# is output in the TSV format.  The sum is over the folds that were
+# evaluated.  The genome column is only output in batch mode and the 
+# number of folds evaluated with early exit.
+# returns a list of strings
+def getTSVRow(options, row):
+	predArr = [p for p in row[3] if not np.isnan(p)]
+	arr = [row[1], row[2], str(sum(predArr))]
+	if options.earlyExit:
+		arr.append(str(len(predArr)))
+	if options.batch != '':
+		arr = [row[0]] + arr
+
+	return arr
+
+# given options, gets the column names of the TSV format, matching 
+# the rows from getTSVRow
+# returns a list of strings
+def getTSVHeader(options):
+	arr = ['PLFam', 'Prediction', 'Sum']
+	if options.earlyExit:
+		arr.append('FoldsEvaluated')
+	if options.batch != '':
+		arr = ['Genome'] + arr
+
+	return arr
+
+# given a row of the prediction table, gets the mean prediction over
+# the folds that were evaluated and the fold predictions with None for
+# folds that weren't evaluated
+# returns [mean, list of fold predictions]
+def getRowScores(row):
+	folds = [None if np.isnan(p) else float(p) for p in row[3]]
+	predArr = [p for p in folds if p is not None]
+	mean = sum(predArr) / float(len(predArr))
+
+	return [mean, folds]
+
+# gets the arrow schema of the parquet and arrow output formats
+def getArrowSchema():
+	return pa.schema([
+		pa.field('genome', pa.string()),
+		pa.field('plf', pa.string()),
+		pa.field('label', pa.string()),
+		pa.field('mean', pa.float64()),
+		pa.field('folds', pa.list_(pa.float32()))
+	])
+
+# given options, opens the output and writes the header of the output
+# format (if it has one)
+# returns a hash holding the output state
+def openOutput(options):
+	out = {'options': options, 'buffer': []}
+
+	if options.outFile == '':
+		out['f'] = sys.stdout
+	else:
+		out['f'] = open(options.outFile, 'wb')
+
+	# create and output the TSV header
+	# the parquet and arrow writers write their own
+	if options.outFormat == 'tsv':
+		out['f'].write('\t'.join(getTSVHeader(options)) + '\n')
+	elif options.outFormat == 'parquet':
+		out['writer'] = pq.ParquetWriter(out['f'], getArrowSchema())
+	elif options.outFormat == 'arrow':
+		out['writer'] = pa.RecordBatchStreamWriter(out['f'], getArrowSchema())
+
+	return out
+
+# given the output state and rows of the prediction table, writes 
+# them.  TSV and JSONL rows are written (and flushed) right away, 
+# parquet and arrow rows are buffered into chunks of OUTCHUNK rows.
+def writeRows(out, rows):
+	options = out['options']
+	f = out['f']
+
+	if options.outFormat == 'tsv':
+		for i in rows:
+			f.write('\t'.join(getTSVRow(options, i)) + '\n')
+		f.flush()
+	elif options.outFormat == 'jsonl':
+		for i in rows:
+			mean, folds = getRowScores(i)
+			f.write(json.dumps({'genome': i[0], 'plf': i[1], 'label': i[2], 'mean': mean, 'folds': folds}) + '\n')
+		f.flush()
+	else:
+		out['buffer'].extend(rows)
+		if len(out['buffer']) >= OUTCHUNK:
+			flushOutput(out)
+
+# given the output state, writes the buffered rows as a parquet row 
+# group or arrow record batch
+def flushOutput(out):
+	rows = out['buffer']
+	if len(rows) == 0:
+		return
+
+	scores = [getRowScores(i) for i in rows]
+	batch = pa.RecordBatch.from_arrays([
+		pa.array([i[0] for i in rows], type=pa.string()),
+		pa.array([i[1] for i in rows], type=pa.string()),
+		pa.array([i[2] for i in rows], type=pa.string()),
+		pa.array([i[0] for i in scores], type=pa.float64()),
+		pa.array([i[1] for i in scores], type=pa.list_(pa.float32()))
+	], ['genome', 'plf', 'label', 'mean', 'folds'])
+
+	if out['options'].outFormat == 'parquet':
+		out['writer'].write_table(pa.Table.from_batches([batch]))
+	else:
+		out['writer'].write_batch(batch)
+	out['buffer'] = []
+
+# given the output state, writes anything left and closes the output
+def closeOutput(out):
+	if 'writer' in out:
+		flushOutput(out)
+		out['writer'].close()
+
+	if out['f'] is sys.stdout:
+		out['f'].flush()
+	else:
+		out['f'].close()
 
 # main driver program
 # get options
+# get genomes to predict on
 # get k-mer size
-# make conserved fasta file
-# run KMC on said fasta file
-# create DMatrix
-# make predictions
-# print predictions
+# get conserved sequences
+# if using KMC, make a private temp directory, make conserved fasta 
+# files and run KMC on them
+# create k-mer matrix (and remove the temp directory)
+# open the output
+# make predictions (or get them from the cache), writing the rows of
+# each PLF as it finishes
+# close the output
+# write profile
+# each stage is timed for the profile
 def main():
 	options, parser = getOptions()
-	k = getK(options)
-	makeConsFastaFile(options)
-	runKMC(options, k)
-	dMat = makeMatrix(options, k)
-	preds = predAll(options, dMat)
-	printPreds(preds)
+	genomes = timeStage('getGenomes', getGenomes, options)
+	k = timeStage('getK', getK, options)
+	seqLst = timeStage('getConsSeqs', getConsSeqs, options, genomes)
+	if options.kmerCounter == 'kmc':
+		makeRunTempDir(options)
+		try:
+			timeStage('runKMC', runKMCAll, options, k, genomes, seqLst)
+			mat = timeStage('makeMatrix', makeMatrix, options, k, genomes, seqLst)
+		finally:
+			shutil.rmtree(options.tempDir)
+	else:
+		mat = timeStage('makeMatrix', makeMatrix, options, k, genomes, seqLst)
+	out = openOutput(options)
+	timeStage('predAll', predCached, options, mat, genomes, partial(writeRows, out))
+	timeStage('closeOutput', closeOutput, out)
+	writeProfile(options, genomes)
 
 if __name__ == '__main__':
 	main()
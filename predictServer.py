@@ -0,0 +1,264 @@
+'''
+python predictServer.py [-opt val] | [--opt val]
+
+Runs a resident prediction service.  All the models are loaded once
+at startup and kept in memory, so each request only pays for k-mer
+counting and prediction.
+
+-p | --cons_plfs : list of conserved PLFs used to train the model
+-m | --models_dir : directory containing all the models which will be predicted on, or a model bundle file made by packModels.py
+-l | --plfs : only serve predictions for these PLFs.  Either a comma separated list of PLF IDs or a file listing them (one per line).  Defaults to every PLF
+-t | --temp_dir : Temporary directory used to hold fasta files, KMC output, etc.  Each request uses its own private directory inside of it.  Defaults to "temp/"
+-k | --kmer_counter : k-mer counter to use, either "numpy" (in process) or "kmc" (runs kmc.sh).  Defaults to "numpy"
+-n | --threads : number of threads to predict with per request.  Defaults to 1
+-e | --engine : inference engine, either "xgb" or "numpy".  Defaults to "xgb"
+--early_exit : stop evaluating folds once the remaining folds can't change the prediction
+-H | --host : host to listen on.  Defaults to "127.0.0.1"
+-P | --port : port to listen on.  Defaults to 8080
+-s | --socket : Unix socket to listen on instead of a host and port
+
+Requests:
+POST /predict : body is a feature tabular file from an annotated
+  genome on BVBRC.  Returns the prediction table from predict.py
+GET /stats : returns request latency and throughput counters as JSON
+'''
+
+import os
+import time
+import json
+import copy
+import shutil
+import threading
+from StringIO import StringIO
+import SocketServer
+from optparse import OptionParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import predict
+from predict import err
+
+# grab options for the script and returns them
+def getOptions():
+	parser = OptionParser()
+
+	parser.add_option('-p', '--cons_plfs', help="List of conserved PLFs that the model is based off of.", metavar='FILE', default='', dest='conPLFFile')
+	parser.add_option('-m', '--models_dir', help="Directory name containing all the models to preedict with.  Each model would be a directory named PLF_XXX_XXXXXXXX.tab.  Can also be a model bundle file made by packModels.py", metavar="DIR", default='', dest='modelsDir')
+	parser.add_option('-l', '--plfs', help="Only serve predictions for these PLFs.  Either a comma separated list of PLF IDs or a file listing them, one per line.  Defaults to every PLF", metavar="STR|FILE", default='', dest='plfs')
+	parser.add_option('-t', '--temp_dir', help="Directory name to be used as a temporary directory.  Each request gets its own private directory inside of it", metavar="DIR", default='temp/', dest='tempDir')
+	parser.add_option('-k', '--kmer_counter', help="K-mer counter to use, either numpy (in process) or kmc (runs kmc.sh).  Defaults to numpy", type='choice', choices=['numpy', 'kmc'], metavar="STR", default='numpy', dest='kmerCounter')
+	parser.add_option('-n', '--threads', help="Number of threads to predict with per request.  Defaults to 1", metavar="INT", type=int, default=1, dest='threads')
+	parser.add_option('-e', '--engine', help="Inference engine, either xgb (XGBoost boosters) or numpy (all trees are converted to arrays and evaluated in batches).  Defaults to xgb", type='choice', choices=['xgb', 'numpy'], metavar="STR", default='xgb', dest='engine')
+	parser.add_option('--early_exit', help="Evaluate folds one at a time and stop once the remaining folds can't change the prediction.  Adds a column with the number of folds evaluated.  Only used by the xgb engine", action='store_true', default=False, dest='earlyExit')
+	parser.add_option('-H', '--host', help="Host to listen on", metavar="STR", default='127.0.0.1', dest='host')
+	parser.add_option('-P', '--port', help="Port to listen on", metavar="INT", type=int, default=8080, dest='port')
+	parser.add_option('-s', '--socket', help="Unix socket to listen on instead of a host and port", metavar="FILE", default='', dest='socket')
+
+	options,args = parser.parse_args()
+
+	predict.setModelsDir(options)
+	predict.setPLFs(options)
+	options.tempDir = predict.cleanDir(options.tempDir)
+	options.batch = ''
+	options.featFile = ''
+	# the boosters are already in memory, so only threads are used
+	options.poolType = 'thread'
+
+	predict.makeDir(options.tempDir, False)
+
+	return options, parser
+
+# given options, loads everything needed to predict that doesn't
+# change between requests
+# returns a hash holding the warm state of the server
+def loadState(options):
+	state = {}
+	state['options'] = options
+	state['k'] = predict.getK(options)
+	state['attrOrder'] = predict.getAttrOrder(options)
+	state['cPLFHsh'] = predict.getConPLFs(options)
+	state['models'] = predict.loadModels(options)
+	state['forests'] = None
+	if options.engine == 'numpy':
+		state['forests'] = predict.makeForests(state['models'])
+	# predictions are serialized, k-mer counting is not
+	state['predLock'] = threading.Lock()
+
+	# request counters
+	state['statLock'] = threading.Lock()
+	state['stats'] = {
+		'start': time.time(),
+		'requests': 0,
+		'errors': 0,
+		'genomes': 0,
+		'latencyTotal': 0.0,
+		'latencyMin': None,
+		'latencyMax': None
+	}
+
+	return state
+
+# given the state, whether the request succeeded, and the latency of
+# the request in seconds, updates the request counters
+def addStat(state, ok, latency):
+	state['statLock'].acquire()
+	try:
+		stats = state['stats']
+		stats['requests'] += 1
+		if ok:
+			stats['genomes'] += 1
+		else:
+			stats['errors'] += 1
+		stats['latencyTotal'] += latency
+		if stats['latencyMin'] is None or latency < stats['latencyMin']:
+			stats['latencyMin'] = latency
+		if stats['latencyMax'] is None or latency > stats['latencyMax']:
+			stats['latencyMax'] = latency
+	finally:
+		state['statLock'].release()
+
+# given the state, gets a summary of the request counters
+# returns a hash of latency and throughput counters
+def getStats(state):
+	state['statLock'].acquire()
+	try:
+		stats = dict(state['stats'])
+	finally:
+		state['statLock'].release()
+
+	uptime = time.time() - stats['start']
+	del stats['start']
+	stats['uptime'] = uptime
+	stats['models'] = len(state['models'])
+	stats['latencyMean'] = 0.0
+	if stats['requests'] > 0:
+		stats['latencyMean'] = stats['latencyTotal'] / stats['requests']
+	stats['throughput'] = 0.0
+	if uptime > 0:
+		stats['throughput'] = stats['requests'] / uptime
+
+	return stats
+
+# given the state and the contents of a feature tabular file, makes
+# predictions for the genome.  KMC, if used, runs in a private temp
+# directory.
+# returns the prediction table as a string
+def predGenome(state, featTab):
+	options = state['options']
+	k = state['k']
+
+	# parse the conserved sequences from the feature tab
+	genomes = [['genome', '', 'genome.fasta']]
+	seqLst = [predict.parseFeatureStream(StringIO(featTab), state['cPLFHsh'])]
+
+	# if using KMC
+	#   copy the options so the temp directory is private to the 
+	#   request
+	#   write the fasta and run KMC
+	#   make the matrix and remove the temp directory
+	# otherwise count k-mers in process
+	if options.kmerCounter == 'kmc':
+		options = copy.copy(options)
+		predict.makeRunTempDir(options)
+		try:
+			predict.makeConsFastaFile(options, seqLst[0], genomes[0][2])
+			predict.runKMC(options, k, genomes[0][2])
+			mat = predict.makeMatrix(options, k, genomes, seqLst, state['attrOrder'])
+		finally:
+			shutil.rmtree(options.tempDir)
+	else:
+		mat = predict.makeMatrix(options, k, genomes, seqLst, state['attrOrder'])
+
+	state['predLock'].acquire()
+	try:
+		preds = predict.predAll(options, mat, genomes, state['models'], state['forests'])
+	finally:
+		state['predLock'].release()
+
+	# create the output table
+	lns = ['\t'.join(predict.getTSVHeader(options))]
+	for i in preds:
+		lns.append('\t'.join(predict.getTSVRow(options, i)))
+
+	return '\n'.join(lns) + '\n'
+
+# request handler for the prediction server
+class PredHandler(BaseHTTPRequestHandler):
+	# given a response code, content type, and body, sends the response
+	def sendBody(self, code, cType, body):
+		self.send_response(code)
+		self.send_header('Content-Type', cType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/stats':
+			body = json.dumps(getStats(self.server.state)) + '\n'
+			self.sendBody(200, 'application/json', body)
+		else:
+			self.sendBody(404, 'text/plain', 'not found\n')
+
+	def do_POST(self):
+		if self.path != '/predict':
+			self.sendBody(404, 'text/plain', 'not found\n')
+			return
+
+		sTime = time.time()
+		try:
+			featTab = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+			body = predGenome(self.server.state, featTab)
+		except Exception as e:
+			addStat(self.server.state, False, time.time() - sTime)
+			self.sendBody(500, 'text/plain', str(e) + '\n')
+			return
+		addStat(self.server.state, True, time.time() - sTime)
+		self.sendBody(200, 'text/tab-separated-values', body)
+
+	# requests are logged to stderr
+	def log_message(self, fmt, *args):
+		err(fmt % args + '\n')
+
+# threaded TCP server
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+# threaded Unix socket server
+class ThreadedUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+# Unix socket handler, there is no client address to log
+class UnixPredHandler(PredHandler):
+	def address_string(self):
+		return 'unix'
+
+	def setup(self):
+		self.client_address = ('unix', 0)
+		PredHandler.setup(self)
+
+# main driver program
+# get options
+# load models
+# serve requests until interrupted
+def main():
+	options, parser = getOptions()
+	state = loadState(options)
+
+	if options.socket != '':
+		if os.path.exists(options.socket):
+			os.remove(options.socket)
+		server = ThreadedUnixHTTPServer(options.socket, UnixPredHandler)
+		err("Serving on " + options.socket + "\n")
+	else:
+		server = ThreadedHTTPServer((options.host, options.port), PredHandler)
+		err("Serving on " + options.host + ':' + str(options.port) + "\n")
+	server.state = state
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	if options.socket != '':
+		os.remove(options.socket)
+
+if __name__ == '__main__':
+	main()